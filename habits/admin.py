@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Habit
+from .models import Habit, HabitOccurrence
 
 
 @admin.register(Habit)
@@ -16,3 +16,10 @@ class HabitAdmin(admin.ModelAdmin):
     autocomplete_fields = ('linked_habit',)
     raw_id_fields = ('user',)
     ordering = ('-created_at',)
+
+
+@admin.register(HabitOccurrence)
+class HabitOccurrenceAdmin(admin.ModelAdmin):
+    list_display = ('id', 'habit', 'minute')
+    raw_id_fields = ('habit',)
+    ordering = ('minute',)
@@ -0,0 +1,209 @@
+"""Single-flight leases for periodic scheduler tasks.
+
+A lease is a key with a TTL and a random owner token (Redis `SET NX PX`):
+only the holder can renew or release it, and a crashed holder frees it
+after the TTL. Contention is counted so overlapping beat ticks are visible in
+metrics. The `local` backend only covers the current process and is meant
+for development and tests.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from habits_project.backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS[1] - lease key; ARGV[1] - owner token. Deletes the key only if we still own it.
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] - lease key; ARGV[1] - owner token, ARGV[2] - new TTL (ms). Extends the TTL only if we still own it.
+_EXTEND_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class LocalLeases:
+    """In-process leases and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases: dict[str, tuple[str, float]] = {}
+        self._counters: dict[str, int] = {}
+
+    def acquire(self, name: str, token: str, ttl: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is not None and holder[1] > now:
+                return False
+            self._leases[name] = (token, now + ttl)
+            return True
+
+    def extend(self, name: str, token: str, ttl: float) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is None or holder[0] != token or holder[1] <= now:
+                return False
+            self._leases[name] = (token, now + ttl)
+            return True
+
+    def release(self, name: str, token: str) -> bool:
+        with self._lock:
+            holder = self._leases.get(name)
+            if holder is None or holder[0] != token:
+                return False
+            del self._leases[name]
+            # Like a Redis key past its TTL: an expired lease was no longer ours
+            return holder[1] > time.monotonic()
+
+    def incr(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + 1
+
+    def counters(self, name: str) -> dict[str, int]:
+        prefix = f"{name}:"
+        with self._lock:
+            return {k[len(prefix):]: v for k, v in self._counters.items() if k.startswith(prefix)}
+
+
+class RedisLeases:
+    """Leases shared by all workers, kept in Redis."""
+
+    def __init__(self, client):
+        self._client = client
+        self._release = self._client.register_script(_RELEASE_LUA)
+        self._extend = self._client.register_script(_EXTEND_LUA)
+
+    def acquire(self, name: str, token: str, ttl: float) -> bool:
+        return bool(self._client.set(f"lease:{name}", token, nx=True, px=int(ttl * 1000)))
+
+    def extend(self, name: str, token: str, ttl: float) -> bool:
+        return bool(self._extend(keys=[f"lease:{name}"], args=[token, int(ttl * 1000)]))
+
+    def release(self, name: str, token: str) -> bool:
+        return bool(self._release(keys=[f"lease:{name}"], args=[token]))
+
+    def incr(self, counter: str) -> None:
+        self._client.hincrby('lease:counters', counter, 1)
+
+    def counters(self, name: str) -> dict[str, int]:
+        prefix = f"{name}:"
+        return {
+            k.decode()[len(prefix):]: int(v)
+            for k, v in self._client.hgetall('lease:counters').items()
+            if k.decode().startswith(prefix)
+        }
+
+
+def get_leases():
+    """Return the configured lease backend, or None when locking is off."""
+    return get_backend('HABITS_SCHEDULER_LOCK_BACKEND', 'HABITS_SCHEDULER_LOCK_REDIS_URL', LocalLeases, RedisLeases)
+
+
+class Lease:
+    """What `single_flight` yields: truthy for the holder.
+
+    A long run calls `renew()` between batches to push the TTL forward, so
+    the lease doesn't expire under it and let the next tick start a second run.
+    """
+
+    def __init__(self, held: bool, leases=None, name: str = '', token: str = '', ttl: float = 0.0):
+        self.held = held
+        self._leases = leases
+        self._name = name
+        self._token = token
+        self._ttl = ttl
+
+    def __bool__(self):
+        return self.held
+
+    def renew(self) -> bool:
+        """Extend the lease by its TTL; False if it was already lost."""
+        if not self.held or self._leases is None:
+            return self.held
+        try:
+            renewed = self._leases.extend(self._name, self._token, self._ttl)
+        except Exception as e:
+            logger.warning("Could not renew lease %s: %s", self._name, e)
+            return True
+        if not renewed:
+            logger.warning("Lease %s expired before it was renewed", self._name)
+        return renewed
+
+
+def _count(leases, name: str, event: str) -> None:
+    try:
+        leases.incr(f"{name}:{event}")
+    except Exception as e:
+        logger.warning("Lease counters unavailable: %s", e)
+
+
+@contextmanager
+def single_flight(name: str, ttl: float | None = None):
+    """Hold the `name` lease for the duration of the block.
+
+    Yields a `Lease`: truthy for the holder and falsy when another run already
+    holds the lease (the caller should skip its work). If the lease store is down the
+    block runs anyway: the idempotency window still guards against duplicates.
+    Counters: `acquired`, `contended` (skipped), `expired` (the run outlived
+    its TTL, so another one may have started meanwhile).
+    """
+    leases = get_leases()
+    if leases is None:
+        yield Lease(True)
+        return
+    if ttl is None:
+        ttl = float(getattr(settings, 'HABITS_SCHEDULER_LOCK_TTL_SECONDS', 300))
+
+    token = uuid.uuid4().hex
+    try:
+        acquired = leases.acquire(name, token, ttl)
+    except Exception as e:
+        logger.warning("Lease store unavailable, running %s without a lock: %s", name, e)
+        acquired = None
+
+    if acquired is None:
+        yield Lease(True)
+        return
+    if not acquired:
+        _count(leases, name, 'contended')
+        yield Lease(False)
+        return
+
+    _count(leases, name, 'acquired')
+    started = time.monotonic()
+    try:
+        yield Lease(True, leases, name, token, ttl)
+    finally:
+        try:
+            released = leases.release(name, token)
+        except Exception as e:
+            logger.warning("Could not release lease %s: %s", name, e)
+        else:
+            if not released:
+                _count(leases, name, 'expired')
+                logger.warning("Lease %s expired after %.1fs, before the run finished", name, time.monotonic() - started)
+
+
+def lease_counters(name: str) -> dict[str, int]:
+    leases = get_leases()
+    if leases is None:
+        return {}
+    return leases.counters(name)
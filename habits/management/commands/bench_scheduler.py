@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+import resource
+import sys
+import time as time_mod
+from contextlib import ExitStack
+from datetime import time, timedelta
+from io import StringIO
+
+import httpx
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from habits.models import Habit
+from habits.tasks import check_and_notify_due_habits, scheduled_habits
+from notifications import telegram
+from notifications.models import TelegramProfile
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark check_and_notify_due_habits on a synthetic population: N users adopt "
+        "the seed_public_habits templates (plus some custom times), Telegram is a local "
+        "fake with configurable latency. Prints JSON with habits/s, queries per tick "
+        "and peak RSS. Runs in a throwaway test database unless --in-place is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--habits', type=int, default=5000, help='Total habits, spread over the users')
+        parser.add_argument('--ticks', type=int, default=5, help='Peak minutes to dispatch, busiest first')
+        parser.add_argument('--latency-ms', type=float, default=50.0, help='Latency of the fake sendMessage')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of fake sendMessage calls that fail')
+        parser.add_argument('--custom-share', type=float, default=0.2, help='Share of habits at a random custom time')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--api-base',
+            help='Send to this Bot API (e.g. manage.py fake_telegram_api) instead of the in-process fake',
+        )
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+        parser.add_argument('--in-place', action='store_true', help='Use the current database (must be disposable)')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['in_place']:
+            # destroy_test_db() switches the connection back to this name
+            old_name = connection.settings_dict['NAME']
+            # SQLite test databases live in memory
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            report = self._run(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as fh:
+                fh.write(payload + '\n')
+        else:
+            self.stdout.write(payload)
+
+    def _run(self, options) -> dict:
+        rng = random.Random(options['seed'])
+        started = time_mod.perf_counter()
+        self._populate(rng, options['users'], options['habits'], options['custom_share'])
+        generate_seconds = time_mod.perf_counter() - started
+
+        with ExitStack() as stack:
+            stack.enter_context(override_settings(
+                TELEGRAM_BOT_TOKEN='bench',
+                TELEGRAM_RATE_LIMIT_BACKEND='',
+                # No Redis needed for a benchmark
+                HABITS_SCHEDULER_LOCK_BACKEND='local',
+                METRICS_BACKEND='local',
+            ))
+            if options['api_base']:
+                stack.enter_context(override_settings(TELEGRAM_API_BASE=options['api_base']))
+                telegram.reset_clients()
+                stack.callback(telegram.reset_clients)
+            else:
+                self._fake_telegram(stack, options['latency_ms'] / 1000, options['error_rate'], rng)
+            # Backlog continuations run inline instead of going to the broker
+            conf = check_and_notify_due_habits.app.conf
+            eager = conf.task_always_eager
+            conf.task_always_eager = True
+            stack.callback(setattr, conf, 'task_always_eager', eager)
+            ticks = self._ticks(options['ticks'])
+
+        total_seconds = sum(t['seconds'] for t in ticks)
+        total_dispatched = sum(t['dispatched'] for t in ticks)
+        return {
+            'python': sys.version.split()[0],
+            'database': connection.vendor,
+            'params': {k: options[k] for k in ('users', 'habits', 'ticks', 'latency_ms', 'error_rate', 'custom_share', 'seed', 'api_base')},
+            'settings': self._settings(),
+            'population': {
+                'users': options['users'],
+                'habits': scheduled_habits().count(),
+                'generate_seconds': round(generate_seconds, 3),
+            },
+            'ticks': ticks,
+            'summary': {
+                'dispatched': total_dispatched,
+                'habits_per_second': round(total_dispatched / total_seconds, 1) if total_seconds else None,
+                'queries_per_tick': round(sum(t['queries'] for t in ticks) / len(ticks), 1) if ticks else None,
+                # ru_maxrss is in KiB on Linux
+                'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            },
+        }
+
+    def _populate(self, rng, users: int, habits: int, custom_share: float) -> None:
+        call_command('seed_public_habits', stdout=StringIO())
+        templates = list(Habit.objects.filter(is_public=True).values('action', 'place', 'time', 'duration_seconds'))
+
+        User = get_user_model()
+        first = User.objects.count()
+        User.objects.bulk_create(
+            [User(username=f'bench{first + i}', password='!') for i in range(users)],
+            batch_size=1000,
+        )
+        owners = list(User.objects.filter(username__startswith='bench').order_by('id').values_list('id', flat=True))
+        TelegramProfile.objects.bulk_create(
+            [TelegramProfile(user_id=user_id, chat_id=10_000_000 + user_id) for user_id in owners],
+            batch_size=1000,
+        )
+
+        batch = []
+        for n in range(habits):
+            template = rng.choice(templates)
+            habit_time = template['time']
+            if rng.random() < custom_share:
+                habit_time = time(rng.randrange(6, 24), rng.randrange(0, 60, 5))
+            batch.append(Habit(
+                user_id=owners[n % len(owners)],
+                place=template['place'], action=template['action'], time=habit_time,
+                duration_seconds=template['duration_seconds'], periodicity_days=rng.choice((1, 1, 1, 2, 7)),
+            ))
+            if len(batch) == 1000:
+                Habit.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            Habit.objects.bulk_create(batch)
+
+    def _fake_telegram(self, stack: ExitStack, latency: float, error_rate: float, rng) -> None:
+        async def handler(request):
+            await asyncio.sleep(latency)
+            if error_rate and rng.random() < error_rate:
+                return httpx.Response(500, json={'ok': False, 'description': 'Internal Server Error'})
+            return httpx.Response(200, json={'ok': True, 'result': {}})
+
+        original = telegram.build_async_client
+        telegram.build_async_client = lambda: httpx.AsyncClient(
+            base_url=telegram.api_base(), transport=httpx.MockTransport(handler),
+        )
+        telegram.reset_clients()
+        stack.callback(telegram.reset_clients)
+        stack.callback(setattr, telegram, 'build_async_client', original)
+
+    def _ticks(self, count: int) -> list[dict]:
+        """Make the busiest minutes due one at a time and dispatch each with one scheduler run."""
+        busiest = scheduled_habits().order_by().values('time').annotate(n=Count('id')).order_by('-n', 'time')
+
+        ticks = []
+        for row in list(busiest[:count]):
+            due, habit_time = row['n'], row['time']
+            now = timezone.now()
+            scheduled_habits().filter(time=habit_time).update(
+                next_run_at=now - timedelta(seconds=1), last_notified_at=None,
+            )
+            with CaptureQueriesContext(connection) as queries:
+                started = time_mod.perf_counter()
+                check_and_notify_due_habits()
+                seconds = time_mod.perf_counter() - started
+            left = scheduled_habits().filter(time=habit_time, next_run_at__lte=now).count()
+            ticks.append({
+                'time': habit_time.strftime('%H:%M'),
+                'due': due,
+                'dispatched': due - left,
+                'seconds': round(seconds, 4),
+                'queries': len(queries),
+                'habits_per_second': round((due - left) / seconds, 1) if seconds else None,
+            })
+        return ticks
+
+    def _settings(self) -> dict:
+        from django.conf import settings
+
+        names = (
+            'HABITS_WRITEBACK_BATCH_SIZE', 'HABITS_COALESCE_DIGEST', 'HABITS_MAX_PER_RUN',
+            'HABITS_USE_OCCURRENCES', 'HABITS_SPREAD_WINDOW_SECONDS', 'HABITS_CLAIM_MODE',
+            'NOTIFICATIONS_USE_OUTBOX', 'TELEGRAM_SEND_CONCURRENCY',
+        )
+        return {name: getattr(settings, name, None) for name in names}
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from habits.occurrences import busiest_minutes, load_at, roll_forward, to_minute
+
+
+class Command(BaseCommand):
+    help = (
+        "Capacity planning from the materialized occurrence table: how many reminders "
+        "are due in a given minute, or the busiest minutes of the next hours."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at', help='Minute to inspect, e.g. "2026-01-01 09:00" (server time zone)')
+        parser.add_argument('--top', type=int, default=10, help='How many busiest minutes to list')
+        parser.add_argument('--hours', type=int, default=24, help='Window for --top, from now')
+        parser.add_argument('--roll', action='store_true', help='Materialize occurrences up to the horizon first')
+
+    def handle(self, *args, **options):
+        if options['roll']:
+            stats = roll_forward()
+            self.stdout.write(f"Materialized {stats['materialized']}, purged {stats['purged']}")
+
+        if options['at']:
+            at = parse_datetime(options['at'])
+            if at is None:
+                raise CommandError(f"Bad --at value: {options['at']!r}")
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+            self.stdout.write(f"{to_minute(at).isoformat()}: {load_at(at)}")
+            return
+
+        start = to_minute(timezone.now())
+        for minute, sends in busiest_minutes(start, start + timedelta(hours=max(1, options['hours'])), options['top']):
+            self.stdout.write(f"{timezone.localtime(minute).isoformat()}: {sends}")
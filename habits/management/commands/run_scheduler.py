@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import heapq
+import logging
+import os
+import signal
+import socket
+import time as time_mod
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from habits_project import metrics
+from habits.schedule import spread_offset, spread_window
+from habits.tasks import (
+    IDEMPOTENCY_WINDOW_SECONDS,
+    claim_due_habits,
+    deliverable_habits,
+    dispatch_habits,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the in-process reminder scheduler: keep a min-heap of next_run_at, "
+        "sleep until the next one is due and dispatch it. Changes are picked up "
+        "by an updated_at watermark; the beat task stays as a fallback."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refresh', type=float, default=5.0, help='Seconds between change polls')
+        parser.add_argument('--batch', type=int, default=500, help='Max habits claimed per dispatch')
+        parser.add_argument('--once', action='store_true', help='Dispatch what is due now and exit')
+
+    def handle(self, *args, **options):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.batch = max(1, options['batch'])
+        self.heap: list[tuple] = []
+        # habit id -> key of its live heap entry; anything else in the heap is stale
+        self.queued: dict[int, object] = {}
+        self.stopping = False
+
+        self._seed()
+        if options['once']:
+            sent = self._run_due(timezone.now())
+            self.stdout.write(self.style.SUCCESS(f"Dispatched {sent} habits"))
+            return
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        refresh = timedelta(seconds=max(0.1, options['refresh']))
+        next_refresh = timezone.now() + refresh
+        self.stdout.write(f"Scheduler started with {len(self.heap)} habits queued")
+
+        while not self.stopping:
+            now = timezone.now()
+            if now >= next_refresh:
+                self._refresh()
+                next_refresh = now + refresh
+            self._run_due(now)
+            metrics.flush()
+
+            wake_at = next_refresh
+            while self.heap and self.queued.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if self.heap and self.heap[0][0] < wake_at:
+                wake_at = self.heap[0][0]
+            delay = (wake_at - timezone.now()).total_seconds()
+            if delay > 0:
+                time_mod.sleep(delay)
+
+        self.stdout.write("Scheduler stopped")
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _push(self, rows) -> None:
+        """Queue `(next_run_at, habit id, user id)` rows."""
+        window = spread_window()
+        coalesce = getattr(settings, 'HABITS_COALESCE_DIGEST', False)
+        for next_run_at, habit_id, user_id in rows:
+            if next_run_at is None:
+                continue
+            # Peak smoothing: each habit (each user, with digests) fires at its own second of the minute
+            key = next_run_at + timedelta(seconds=spread_offset(user_id if coalesce else habit_id, window))
+            if self.queued.get(habit_id) == key:
+                continue
+            self.queued[habit_id] = key
+            heapq.heappush(self.heap, (key, habit_id))
+
+    def _seed(self) -> None:
+        qs = deliverable_habits()
+        self.watermark = qs.aggregate(m=Max('updated_at'))['m']
+        self._push(qs.filter(next_run_at__isnull=False).order_by().values_list('next_run_at', 'id', 'user_id'))
+
+    def _refresh(self) -> None:
+        """Queue habits created or edited since the last poll.
+
+        Deleted habits and stale heap entries are dropped lazily: popped ids
+        are re-validated by the claim query. Habits of users who link Telegram
+        later are left to the beat fallback.
+        """
+        if self.watermark is None:
+            changed = deliverable_habits()
+        else:
+            # Small overlap so rows committed out of updated_at order are not missed
+            changed = deliverable_habits().filter(updated_at__gte=self.watermark - timedelta(seconds=1))
+        rows = list(changed.order_by().values_list('next_run_at', 'id', 'user_id', 'updated_at'))
+        if rows:
+            self.watermark = max(max(r[3] for r in rows), self.watermark or rows[0][3])
+        self._push(r[:3] for r in rows)
+
+    def _run_due(self, now) -> int:
+        due_ids = set()
+        while self.heap and self.heap[0][0] <= now:
+            key, habit_id = heapq.heappop(self.heap)
+            if self.queued.get(habit_id) == key:
+                del self.queued[habit_id]
+                due_ids.add(habit_id)
+        if not due_ids:
+            return 0
+
+        sent = 0
+        pending = sorted(due_ids)
+        while pending:
+            chunk, pending = pending[:self.batch], pending[self.batch:]
+            with metrics.timed('habits_scheduler_phase_seconds', phase='claim'):
+                claimed = claim_due_habits(self.worker_id, now, len(chunk), ids=chunk)
+            sent += dispatch_habits(claimed, now)
+
+            retry_at = now + timedelta(seconds=IDEMPOTENCY_WINDOW_SECONDS)
+            self._push((h.next_run_at if h.next_run_at > now else retry_at, h.id, h.user_id) for h in claimed)
+
+            # Not claimed: moved to the future, leased elsewhere, deleted or made public
+            rest = set(chunk) - {h.id for h in claimed}
+            if rest:
+                self._push(
+                    (next_run_at if next_run_at > now else retry_at, habit_id, user_id)
+                    for next_run_at, habit_id, user_id in (
+                        deliverable_habits().filter(id__in=rest, next_run_at__isnull=False)
+                        .order_by().values_list('next_run_at', 'id', 'user_id')
+                    )
+                )
+        return sent
@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from habits_project import metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Print scheduler and Telegram metrics (dispatch lag, phase durations, rows, "
+        "errors) in the Prometheus text format, without an external collector."
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(metrics.render_text(), ending='')
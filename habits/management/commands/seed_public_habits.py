@@ -6,7 +6,7 @@ from typing import Iterable
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
 
-from habits.models import Habit
+from habits.models import PUBLIC_USERNAME, Habit
 
 
 def t(hhmm: str) -> time:
@@ -17,7 +17,7 @@ def t(hhmm: str) -> time:
 class Command(BaseCommand):
     help = "Seed public habit templates (idempotent)."
 
-    PUBLIC_USERNAME = "public"
+    PUBLIC_USERNAME = PUBLIC_USERNAME
 
     def handle(self, *args, **options):
         User = get_user_model()
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import csv
+import json
+import time as time_mod
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from habits.simulation import simulate
+from habits.tasks import deliverable_habits, scheduled_habits
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay the scheduler over a simulated period with a virtual clock, without sending "
+        "anything: per-minute histogram of sends, peak minute, per-user max messages per "
+        "minute and projected Telegram API calls. Point DATABASE_URL at a copy of production "
+        "data; only reads are made."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', help='Virtual start, e.g. "2026-01-05 00:00" (default: now)')
+        parser.add_argument('--days', type=int, default=7)
+        parser.add_argument('--linked-only', action='store_true', help='Only users with a linked Telegram chat')
+        parser.add_argument(
+            '--coalesce', action='store_true', default=None,
+            help='Project API calls with one digest per user (default: HABITS_COALESCE_DIGEST)',
+        )
+        parser.add_argument('--histogram', help='Write the per-minute histogram to this CSV file')
+        parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+
+    def handle(self, *args, **options):
+        start = timezone.now()
+        if options['start']:
+            start = parse_datetime(options['start'])
+            if start is None:
+                raise CommandError(f"Bad --start value: {options['start']!r}")
+            if timezone.is_naive(start):
+                start = timezone.make_aware(start)
+        coalesce = options['coalesce']
+        if coalesce is None:
+            coalesce = getattr(settings, 'HABITS_COALESCE_DIGEST', False)
+
+        qs = deliverable_habits() if options['linked_only'] else scheduled_habits()
+        started = time_mod.perf_counter()
+        result = simulate(qs, start, days=max(1, options['days']))
+        elapsed = time_mod.perf_counter() - started
+
+        calls = result.api_calls(coalesce)
+        peak_minute, peak_sends = result.peak()
+        peak_calls_minute, peak_calls = result.peak(coalesce)
+        # Minutes the bot can't drain within the minute at the global Bot API limit
+        capacity = float(getattr(settings, 'TELEGRAM_GLOBAL_RATE', 30)) * 60
+        summary = {
+            'start': result.start.isoformat(),
+            'end': result.end.isoformat(),
+            'habits': result.habits,
+            'distinct_schedules': result.schedules,
+            'sends': result.total_sends,
+            'busy_minutes': len(result.sends),
+            'peak_minute': timezone.localtime(peak_minute).isoformat() if peak_minute else None,
+            'peak_sends': peak_sends,
+            'max_per_user_per_minute': result.max_per_user_minute,
+            'coalesce': coalesce,
+            'api_calls': sum(calls.values()),
+            'peak_api_calls_minute': timezone.localtime(peak_calls_minute).isoformat() if peak_calls_minute else None,
+            'peak_api_calls': peak_calls,
+            'peak_api_calls_per_second': round(peak_calls / 60, 2),
+            'minutes_over_rate_limit': sum(1 for n in calls.values() if n > capacity),
+            'elapsed_seconds': round(elapsed, 3),
+        }
+
+        if options['histogram']:
+            with open(options['histogram'], 'w', newline='', encoding='utf-8') as fh:
+                writer = csv.writer(fh)
+                writer.writerow(['minute', 'sends', 'api_calls'])
+                for minute in sorted(result.sends):
+                    writer.writerow([timezone.localtime(minute).isoformat(), result.sends[minute], calls[minute]])
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        for key, value in summary.items():
+            self.stdout.write(f"{key}: {value}")
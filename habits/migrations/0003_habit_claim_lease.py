@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0002_schedule_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='habit',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='Захвачена воркером'),
+        ),
+        migrations.AddField(
+            model_name='habit',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Аренда до'),
+        ),
+    ]
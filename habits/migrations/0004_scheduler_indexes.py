@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0003_habit_claim_lease'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='habit',
+            index=models.Index(condition=models.Q(('is_public', False)), fields=['next_run_at'], name='habit_due_scan_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='habit',
+            index=models.Index(fields=['user', '-created_at'], name='habit_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def _next_run(habit_time, periodicity_days, now):
+    # Frozen copy of habits.schedule.calc_next_run as of this migration
+    today_dt = timezone.make_aware(
+        datetime(now.year, now.month, now.day, habit_time.hour, habit_time.minute, habit_time.second),
+        timezone.get_current_timezone(),
+    )
+    if now <= today_dt:
+        return today_dt
+    return today_dt + timedelta(days=int(periodicity_days))
+
+
+def forwards(apps, schema_editor):
+    # next_run_at is now set on every write; schedule the rows created before that
+    Habit = apps.get_model('habits', 'Habit')
+    now = timezone.now()
+    pending = Habit.objects.filter(next_run_at__isnull=True)
+    # One UPDATE per (time, periodicity_days) group
+    groups = pending.order_by().values_list('time', 'periodicity_days').distinct()
+    for habit_time, periodicity_days in list(groups):
+        pending.filter(time=habit_time, periodicity_days=periodicity_days).update(
+            next_run_at=_next_run(habit_time, periodicity_days, now),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0004_scheduler_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
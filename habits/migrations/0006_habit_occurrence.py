@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 16:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0005_init_next_run_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HabitOccurrence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('minute', models.DateTimeField(verbose_name='Минута запуска')),
+                ('habit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occurrences', to='habits.habit', verbose_name='Привычка')),
+            ],
+            options={
+                'verbose_name': 'Запуск привычки',
+                'verbose_name_plural': 'Запуски привычек',
+                'constraints': [models.UniqueConstraint(fields=('minute', 'habit'), name='habit_occurrence_unique_minute')],
+            },
+        ),
+    ]
@@ -1,13 +1,56 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 
+from .schedule import calc_next_run, reschedule
 from .validators import (
     validate_duration_seconds,
     validate_periodicity_days,
 )
 
 
+# Системный владелец публичных шаблонов (см. seed_public_habits)
+PUBLIC_USERNAME = 'public'
+
+
+def _rebuild_occurrences(habit_ids) -> None:
+    if habit_ids and getattr(settings, 'HABITS_USE_OCCURRENCES', False):
+        from .occurrences import rebuild_occurrences
+
+        rebuild_occurrences(habit_ids)
+
+
+class HabitQuerySet(models.QuerySet):
+    """Keeps `next_run_at` in sync on bulk write paths that bypass `Habit.save()`."""
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            if obj.next_run_at is None:
+                obj.next_run_at = obj.calc_next_run()
+        created = super().bulk_create(objs, *args, **kwargs)
+        _rebuild_occurrences([obj.pk for obj in created if obj.pk is not None])
+        return created
+
+    def update(self, **kwargs):
+        if not SCHEDULE_FIELDS.intersection(kwargs) or 'next_run_at' in kwargs:
+            return super().update(**kwargs)
+        # The filter may depend on the fields being changed: remember the rows first
+        ids = list(self.values_list('pk', flat=True))
+        # auto_now is not applied by QuerySet.update; run_scheduler watches `updated_at`
+        kwargs.setdefault('updated_at', timezone.now())
+        updated = super().update(**kwargs)
+        reschedule(self.model.objects.filter(pk__in=ids))
+        _rebuild_occurrences(ids)
+        return updated
+
+
+# Поля, от которых зависит next_run_at
+SCHEDULE_FIELDS = frozenset({'time', 'periodicity_days'})
+
+
 class Habit(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='habits', verbose_name='Пользователь')
     place = models.CharField(max_length=255, verbose_name='Место')
@@ -26,18 +69,67 @@ class Habit(models.Model):
     # Напоминания/планировщик
     last_notified_at = models.DateTimeField(null=True, blank=True, verbose_name='Последнее уведомление')
     next_run_at = models.DateTimeField(null=True, blank=True, verbose_name='Следующий запуск')
+    # Аренда привычки воркером планировщика (claim mode)
+    claimed_by = models.CharField(max_length=64, blank=True, default='', verbose_name='Захвачена воркером')
+    claimed_until = models.DateTimeField(null=True, blank=True, verbose_name='Аренда до')
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = HabitQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Привычка'
         verbose_name_plural = 'Привычки'
         ordering = ['-created_at']
+        indexes = [
+            # Скан планировщика: next_run_at <= now только по непубличным привычкам
+            models.Index(fields=['next_run_at'], condition=Q(is_public=False), name='habit_due_scan_idx'),
+            # Список своих привычек: filter(user=...).order_by('-created_at')
+            models.Index(fields=['user', '-created_at'], name='habit_user_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.action} @ {self.time} ({'приятная' if self.is_pleasant else 'полезная'})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_schedule = instance._schedule_key()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_schedule = self._schedule_key()
+
+    def _schedule_key(self):
+        # Deferred fields are not in __dict__: don't trigger a query for them
+        habit_time = self.__dict__.get('time')
+        periodicity_days = self.__dict__.get('periodicity_days')
+        return (
+            self._meta.get_field('time').to_python(habit_time) if habit_time is not None else None,
+            int(periodicity_days) if periodicity_days is not None else None,
+        )
+
+    def calc_next_run(self, now=None):
+        habit_time = self._meta.get_field('time').to_python(self.time)
+        return calc_next_run(habit_time, self.periodicity_days, now=now)
+
+    def save(self, *args, **kwargs):
+        # Новая привычка или изменились время/периодичность — пересчитать следующий запуск,
+        # чтобы напоминание пришло уже в новое время
+        loaded = getattr(self, '_loaded_schedule', None)
+        rescheduled = self.next_run_at is None or (loaded is not None and loaded != self._schedule_key())
+        if rescheduled:
+            self.next_run_at = self.calc_next_run()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'next_run_at'}
+        super().save(*args, **kwargs)
+        self._loaded_schedule = self._schedule_key()
+        if rescheduled:
+            _rebuild_occurrences([self.pk])
+
     def clean(self):
         # Периодичность ограничена валидатором validate_periodicity_days
 
@@ -59,3 +151,20 @@ class Habit(models.Model):
                 raise ValidationError('У приятной привычки не должно быть связанной привычки.')
 
         # Нельзя выполнять привычку реже, чем 1 раз в 7 дней — обеспечено валидатором диапазона
+
+
+class HabitOccurrence(models.Model):
+    """Материализованный запуск привычки на ближайшие дни, с точностью до минуты (UTC)."""
+
+    habit = models.ForeignKey(Habit, on_delete=models.CASCADE, related_name='occurrences', verbose_name='Привычка')
+    minute = models.DateTimeField(verbose_name='Минута запуска')
+
+    class Meta:
+        verbose_name = 'Запуск привычки'
+        verbose_name_plural = 'Запуски привычек'
+        constraints = [
+            models.UniqueConstraint(fields=['minute', 'habit'], name='habit_occurrence_unique_minute'),
+        ]
+
+    def __str__(self):
+        return f"{self.habit_id} @ {self.minute}"
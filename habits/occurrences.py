@@ -0,0 +1,152 @@
+"""Materialized upcoming occurrences (`HabitOccurrence`) keyed by UTC minute.
+
+Every scheduled habit has a row per run within `HABITS_OCCURRENCE_HORIZON_DAYS`.
+The scheduler reads the current minute bucket instead of range-scanning
+`Habit.next_run_at`; the buckets also answer capacity questions cheaply.
+"""
+from __future__ import annotations
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import HabitOccurrence
+from .schedule import calc_next_run
+
+
+def horizon(now=None):
+    if now is None:
+        now = timezone.now()
+    return now + timedelta(days=int(getattr(settings, 'HABITS_OCCURRENCE_HORIZON_DAYS', 7)))
+
+
+def to_minute(dt):
+    return dt.replace(second=0, microsecond=0)
+
+
+def occurrence_minutes(next_run_at, periodicity_days: int, until) -> list:
+    """Runs from `next_run_at` every `periodicity_days` up to `until`, as minutes.
+
+    Days are added in local time, like `calc_next_run` does.
+    """
+    step = timedelta(days=max(1, int(periodicity_days)))
+    run = timezone.localtime(next_run_at)
+    minutes = []
+    while run <= until:
+        minutes.append(to_minute(run))
+        run += step
+    return minutes
+
+
+def _scheduled():
+    # Late import: tasks imports this module
+    from .tasks import scheduled_habits
+
+    return scheduled_habits()
+
+
+def materialize(rows, until, batch_size: int = 1000) -> int:
+    """Insert occurrences for `(habit_id, next_run_at, periodicity_days)` rows up to `until`.
+
+    Existing occurrences are kept (the insert ignores duplicates), so this can
+    be re-run over the same habits. Returns the number of rows attempted.
+    """
+    batch, total = [], 0
+    for habit_id, next_run_at, periodicity_days in rows:
+        if next_run_at is None:
+            continue
+        for minute in occurrence_minutes(next_run_at, periodicity_days, until):
+            batch.append(HabitOccurrence(habit_id=habit_id, minute=minute))
+        if len(batch) >= batch_size:
+            HabitOccurrence.objects.bulk_create(batch, ignore_conflicts=True)
+            total += len(batch)
+            batch = []
+    if batch:
+        HabitOccurrence.objects.bulk_create(batch, ignore_conflicts=True)
+        total += len(batch)
+    return total
+
+
+def rebuild_occurrences(habit_ids, now=None) -> None:
+    """Replace the occurrences of `habit_ids` after their schedule changed."""
+    with transaction.atomic():
+        HabitOccurrence.objects.filter(habit_id__in=habit_ids).delete()
+        rows = _scheduled().filter(id__in=habit_ids).values_list('id', 'next_run_at', 'periodicity_days')
+        materialize(rows, horizon(now))
+
+
+def roll_forward(now=None) -> dict:
+    """Daily maintenance: extend every habit up to the horizon and drop old buckets."""
+    if now is None:
+        now = timezone.now()
+    rows = (
+        _scheduled()
+        .filter(next_run_at__isnull=False)
+        .order_by()
+        .values_list('id', 'next_run_at', 'periodicity_days')
+        .iterator(chunk_size=2000)
+    )
+    created = materialize(rows, horizon(now))
+    # Buckets the scheduler should have consumed long ago (e.g. while it was switched off)
+    purged, _ = HabitOccurrence.objects.filter(minute__lt=now - timedelta(days=1)).delete()
+    return {'materialized': created, 'purged': purged}
+
+
+def buckets_missing(now) -> bool:
+    """True when habits are scheduled but no bucket lies ahead of `now`.
+
+    That is the state right after `HABITS_USE_OCCURRENCES` is switched on:
+    the write hooks only fill the table while the flag is on.
+    """
+    if HabitOccurrence.objects.filter(minute__gt=now).exists():
+        return False
+    return _scheduled().filter(next_run_at__isnull=False).exists()
+
+
+def due_occurrences(now, limit: int) -> list[tuple[int, int]]:
+    """`(occurrence id, habit id)` of buckets up to the current minute."""
+    return list(
+        HabitOccurrence.objects
+        .filter(minute__lte=now)
+        .order_by('minute')
+        .values_list('id', 'habit_id')[:limit]
+    )
+
+
+def requeue(habit_ids, deliverable_ids, now) -> None:
+    """Make sure every consumed habit has a bucket for its next run.
+
+    Dispatched habits are already covered by the horizon. Habits still due
+    (idempotency window, flood limit) go back at their `next_run_at`; those
+    that can't be delivered yet (no Telegram) wait for their next natural run.
+    """
+    rows = []
+    for habit_id, next_run_at, habit_time, periodicity_days in (
+        _scheduled().filter(id__in=habit_ids).values_list('id', 'next_run_at', 'time', 'periodicity_days')
+    ):
+        if next_run_at is None:
+            continue
+        if next_run_at <= now and habit_id not in deliverable_ids:
+            next_run_at = calc_next_run(habit_time, periodicity_days, now=now + timedelta(seconds=1))
+        rows.append(HabitOccurrence(habit_id=habit_id, minute=to_minute(next_run_at)))
+    HabitOccurrence.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+def load_at(minute) -> int:
+    """How many sends are due in `minute` (capacity planning)."""
+    return HabitOccurrence.objects.filter(minute=to_minute(minute)).count()
+
+
+def busiest_minutes(start, end, top: int = 10) -> list[tuple]:
+    """`(minute, sends)` of the busiest minutes in `[start, end)`."""
+    return list(
+        HabitOccurrence.objects
+        .filter(minute__gte=start, minute__lt=end)
+        .values('minute')
+        .annotate(n=Count('id'))
+        .order_by('-n', 'minute')
+        .values_list('minute', 'n')[:top]
+    )
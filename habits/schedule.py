@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+# Knuth's multiplicative hash: consecutive ids land far apart in the window
+_HASH_MULTIPLIER = 2654435761
+
+
+def calc_next_run(habit_time, periodicity_days: int, now=None):
+    """Return timezone-aware datetime for the next run.
+
+    - If today's time hasn't passed yet, schedule for today at `habit_time`.
+    - Otherwise, schedule for today + `periodicity_days` at `habit_time`.
+    """
+    if now is None:
+        now = timezone.now()
+
+    # Build today's datetime at habit_time in the same timezone
+    tz = timezone.get_current_timezone()
+    today_dt = timezone.make_aware(
+        datetime(now.year, now.month, now.day, habit_time.hour, habit_time.minute, habit_time.second),
+        tz,
+    )
+
+    # If today's time hasn't passed yet (including equality), schedule for today.
+    # Otherwise, move by `periodicity_days`.
+    if now <= today_dt:
+        return today_dt
+    return today_dt + timedelta(days=int(periodicity_days))
+
+
+def reschedule(qs, now=None) -> int:
+    """Recalculate `next_run_at` for every habit in `qs` from its `time`/`periodicity_days`.
+
+    Habits sharing `time` and `periodicity_days` get the same next run from
+    `calc_next_run`, so rows are updated with one UPDATE per such group
+    instead of one save() per habit. Returns the number of updated rows.
+    """
+    if now is None:
+        now = timezone.now()
+
+    groups = qs.order_by().values_list('time', 'periodicity_days').distinct()
+
+    updated = 0
+    for habit_time, periodicity_days in list(groups):
+        updated += qs.filter(time=habit_time, periodicity_days=periodicity_days).update(
+            next_run_at=calc_next_run(habit_time, periodicity_days, now=now),
+            updated_at=timezone.now(),
+        )
+    return updated
+
+
+def init_next_run_at(qs, now=None) -> int:
+    """Initialize `next_run_at` for habits in `qs` where it's still NULL."""
+    return reschedule(qs.filter(next_run_at__isnull=True), now=now)
+
+
+def spread_window() -> int:
+    """Seconds of `HABITS_SPREAD_WINDOW_SECONDS`, capped so a reminder never leaves its minute."""
+    return min(60, max(0, int(getattr(settings, 'HABITS_SPREAD_WINDOW_SECONDS', 0))))
+
+
+def spread_offset(habit_id: int, window: int | None = None) -> int:
+    """Stable per-habit dispatch offset in whole seconds within `[0, window)`."""
+    if window is None:
+        window = spread_window()
+    if window <= 1:
+        return 0
+    return ((habit_id * _HASH_MULTIPLIER) % 2**32) * window >> 32
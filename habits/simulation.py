@@ -0,0 +1,108 @@
+"""Replay the scheduler over a simulated period with a virtual clock (capacity planning).
+
+Nothing is sent or written. Habits sharing `time`, `periodicity_days` and
+`next_run_at` fire at exactly the same moments, so the database groups them
+and each group is expanded once with `calc_next_run`: the work grows with the
+number of distinct schedules, not with the number of habits. Only users with
+several habits at the same time are expanded individually, to find per-user
+bursts and what digests (`HABITS_COALESCE_DIGEST`) would save.
+"""
+from __future__ import annotations
+
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import timedelta, timezone as dt_timezone
+
+from django.db.models import Count
+from django.utils import timezone
+
+from .occurrences import to_minute
+from .schedule import calc_next_run
+
+
+@dataclass
+class SimulationResult:
+    start: object
+    end: object
+    # UTC minute -> reminders due
+    sends: Counter = field(default_factory=Counter)
+    # UTC minute -> sendMessage calls saved by one digest per user
+    coalesced: Counter = field(default_factory=Counter)
+    max_per_user_minute: int = 0
+    habits: int = 0
+    schedules: int = 0
+
+    @property
+    def total_sends(self) -> int:
+        return sum(self.sends.values())
+
+    def api_calls(self, coalesce: bool = False) -> Counter:
+        if not coalesce:
+            return self.sends
+        return Counter({minute: n - self.coalesced[minute] for minute, n in self.sends.items()})
+
+    def peak(self, coalesce: bool = False) -> tuple:
+        calls = self.api_calls(coalesce)
+        if not calls:
+            return None, 0
+        # Earliest of the busiest minutes
+        return min(calls.items(), key=lambda item: (-item[1], item[0]))
+
+
+def fire_times(habit_time, periodicity_days: int, next_run_at, start, end) -> list:
+    """Virtual-clock runs of one schedule in `[start, end)`, as UTC minutes.
+
+    An overdue `next_run_at` fires at `start` (the first tick catches it up);
+    after every send the next run comes from `calc_next_run`, like in
+    `dispatch_habits`.
+    """
+    fired = max(next_run_at, start)
+    if fired >= end:
+        return []
+    minutes = [to_minute(fired.astimezone(dt_timezone.utc))]
+    step = timedelta(days=max(1, int(periodicity_days)))
+    # Days are added in local time, like calc_next_run does
+    run = timezone.localtime(calc_next_run(habit_time, periodicity_days, now=fired + timedelta(seconds=1)))
+    while run < end:
+        minutes.append(to_minute(run.astimezone(dt_timezone.utc)))
+        run += step
+    return minutes
+
+
+def simulate(qs, start, days: int = 7, chunk_size: int = 1000) -> SimulationResult:
+    """Replay the habits of `qs` from `start` for `days` days."""
+    end = start + timedelta(days=days)
+    result = SimulationResult(start=start, end=end)
+    qs = qs.filter(next_run_at__isnull=False, next_run_at__lt=end).order_by()
+
+    groups = qs.values_list('time', 'periodicity_days', 'next_run_at').annotate(n=Count('id'))
+    for habit_time, periodicity_days, next_run_at, n in groups.iterator(chunk_size=chunk_size):
+        result.schedules += 1
+        result.habits += n
+        for minute in fire_times(habit_time, periodicity_days, next_run_at, start, end):
+            result.sends[minute] += n
+    if result.habits:
+        result.max_per_user_minute = 1
+
+    # Only habits of one user at the same time (or overdue ones, all caught up
+    # at `start`) can land in the same minute
+    crowded = sorted(
+        set(qs.values('user_id', 'time').annotate(n=Count('id')).filter(n__gt=1).values_list('user_id', flat=True))
+        | set(qs.filter(next_run_at__lt=start).values('user_id').annotate(n=Count('id')).filter(n__gt=1)
+              .values_list('user_id', flat=True))
+    )
+    for i in range(0, len(crowded), chunk_size):
+        per_user: dict[int, Counter] = {}
+        rows = qs.filter(user_id__in=crowded[i:i + chunk_size]).values_list(
+            'user_id', 'time', 'periodicity_days', 'next_run_at',
+        )
+        for user_id, habit_time, periodicity_days, next_run_at in rows.iterator(chunk_size=chunk_size):
+            per_user.setdefault(user_id, Counter()).update(
+                fire_times(habit_time, periodicity_days, next_run_at, start, end),
+            )
+        for minutes in per_user.values():
+            for minute, n in minutes.items():
+                if n > 1:
+                    result.coalesced[minute] += n - 1
+                    result.max_per_user_minute = max(result.max_per_user_minute, n)
+    return result
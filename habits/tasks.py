@@ -1,80 +1,619 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
+import logging
+import os
+import socket
+import uuid
+from datetime import timedelta
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Mod
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from celery import shared_task
 
-from .models import Habit
-from notifications.services import send_telegram_message
+from . import occurrences
+from habits_project import metrics
+from .locks import single_flight
+from .models import PUBLIC_USERNAME, Habit, HabitOccurrence
+from .schedule import calc_next_run, init_next_run_at, spread_offset, spread_window  # noqa: F401 (re-exported)
+from notifications.models import NotificationOutbox
+from notifications.services import send_telegram_messages_batch
 
+logger = logging.getLogger(__name__)
 
-def calc_next_run(habit_time, periodicity_days: int, now=None):
-    """Return timezone-aware datetime for the next run.
+# Habits notified less than this many seconds ago are not notified again
+IDEMPOTENCY_WINDOW_SECONDS = 90
 
-    - If today's time hasn't passed yet, schedule for today at `habit_time`.
-    - Otherwise, schedule for today + `periodicity_days` at `habit_time`.
+# Single-flight lease of the beat-triggered scan (see habits.locks)
+SCHEDULER_LEASE = 'habits:check_and_notify_due_habits'
+
+# What to do with occurrences overdue by more than HABITS_STALE_AFTER_SECONDS
+STALE_SEND = 'send'
+STALE_SKIP = 'skip'
+STALE_COLLAPSE = 'collapse'
+STALE_POLICIES = (STALE_SEND, STALE_SKIP, STALE_COLLAPSE)
+
+
+def scheduled_habits():
+    """Habits the scheduler is responsible for.
+
+    Public templates and any habits owned by the `public` user are skipped.
+    The owner is excluded by id through a subquery, so building the queryset
+    runs no query, the scan needs no join on the user table and can use the
+    partial `next_run_at WHERE NOT is_public` index.
+    """
+    public_user_ids = get_user_model().objects.filter(username=PUBLIC_USERNAME).values('id')
+    return Habit.objects.filter(is_public=False).exclude(user_id__in=public_user_ids)
+
+
+def deliverable_habits(qs=None):
+    """Scheduled habits (`qs`, by default `scheduled_habits()`) whose owner has a linked Telegram chat.
+
+    This does join the user and the Telegram profile: the chat is fetched in
+    the same query (`user__telegram`), so dispatching a batch needs no
+    per-habit profile lookups.
+    """
+    if qs is None:
+        qs = scheduled_habits()
+    return qs.select_related('user__telegram').filter(user__telegram__isnull=False)
+
+
+def stale_policy() -> str:
+    """`HABITS_STALE_POLICY`; an unknown value falls back to `send`, so no reminder is dropped by a typo."""
+    policy = str(getattr(settings, 'HABITS_STALE_POLICY', STALE_SEND)).strip().lower()
+    if policy not in STALE_POLICIES:
+        logger.error(
+            "Unknown HABITS_STALE_POLICY %r (expected one of %s), sending overdue reminders",
+            policy, ', '.join(STALE_POLICIES),
+        )
+        return STALE_SEND
+    return policy
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def _unclaimed(now):
+    # Not leased by a claim worker, or the lease has already expired
+    return Q(claimed_until__isnull=True) | Q(claimed_until__lte=now)
+
+
+def _reminder_text(h: Habit) -> str:
+    time_str = h.time.strftime('%H:%M') if h.time else ''
+    place_str = f" в месте: {h.place}" if h.place else ''
+    return f"Напоминание о привычке:\n• {h.action}{place_str}\n⏰ {time_str}"
+
+
+def write_back_dispatched(habits, outbox=None) -> None:
+    """Persist `last_notified_at`/`next_run_at` of dispatched habits and release their claims.
+
+    One bulk UPDATE inside a transaction: the batch is either written
+    completely or not at all. `outbox` rows are enqueued in the same
+    transaction; an occurrence already in the outbox is not enqueued twice.
+    """
+    if not habits:
+        return
+    with transaction.atomic():
+        if outbox:
+            NotificationOutbox.objects.bulk_create(outbox, ignore_conflicts=True)
+        Habit.objects.bulk_update(
+            habits,
+            ['last_notified_at', 'next_run_at', 'claimed_by', 'claimed_until'],
+            batch_size=len(habits),
+        )
+
+
+def _digest_text(habits, title: str = 'Напоминания о привычках:') -> str:
+    if len(habits) == 1:
+        return _reminder_text(habits[0])
+    lines = []
+    for h in habits:
+        time_str = h.time.strftime('%H:%M') if h.time else ''
+        place_str = f" в месте: {h.place}" if h.place else ''
+        lines.append(f"• {h.action}{place_str} ⏰ {time_str}")
+    return f"{title}\n" + "\n".join(lines)
+
+
+def _chunks(iterable, size: int, key=None):
+    """Split `iterable` into lists of about `size` items.
+
+    With `key`, a chunk is only cut between items with different keys, so
+    e.g. one user's habits always end up in the same chunk.
+    """
+    chunk = []
+    for item in iterable:
+        if len(chunk) >= size and (key is None or key(item) != key(chunk[-1])):
+            yield chunk
+            chunk = []
+        chunk.append(item)
+    if chunk:
+        yield chunk
+
+
+def _group_by_user(habits) -> list[list[Habit]]:
+    by_user: dict[int, list[Habit]] = {}
+    for h in habits:
+        by_user.setdefault(h.user_id, []).append(h)
+    return list(by_user.values())
+
+
+def _send_reminders(groups) -> dict:
+    """Send one message per `(habits, title)` group concurrently.
+
+    A group of several habits is rendered as one digest and all of them share
+    its result. Returns `{habit id: SendResult}`. Habits must come from
+    `deliverable_habits()`: the chat id is read from the joined `user.telegram`.
+    """
+    items = [(habits[0].user.telegram.chat_id, _digest_text(habits, title)) for habits, title in groups]
+    results = {}
+    for (habits, _title), result in zip(groups, send_telegram_messages_batch(items)):
+        for h in habits:
+            results[h.id] = result
+    return results
+
+
+def _advance(habits, results, now, sent_at, next_runs, use_outbox) -> int:
+    """Move the schedule of sent `habits` forward in memory; returns how many were processed."""
+    processed = 0
+    for h in habits:
+        skipped = h.id not in results
+        sent = results.get(h.id)
+        retry_after = getattr(sent, 'retry_after', None)
+        if retry_after:
+            # Flood limit: keep the occurrence and come back when Telegram allows it
+            h.next_run_at = now + timedelta(seconds=retry_after)
+            continue
+        if not skipped:
+            # Regardless of sent result, move the schedule to avoid spamming
+            h.last_notified_at = now if sent else h.last_notified_at or now
+            if sent and not use_outbox:
+                metrics.observe('habits_dispatch_lag_seconds', max(0.0, (sent_at - h.next_run_at).total_seconds()))
+        # Advance reference time by 1 second to ensure next run moves to the future day
+        key = (h.time, h.periodicity_days)
+        if key not in next_runs:
+            next_runs[key] = calc_next_run(h.time, h.periodicity_days, now=now + timedelta(seconds=1))
+        h.next_run_at = next_runs[key]
+        processed += 1
+    return processed
+
+
+def dispatch_habits(habits, now, lease=None) -> int:
+    """Send reminders for due `habits` and move their schedule forward.
+
+    Habits are handled in batches of `HABITS_WRITEBACK_BATCH_SIZE`: each batch
+    is sent concurrently (at most `TELEGRAM_SEND_CONCURRENCY` requests in
+    flight) and its results are written back in one transaction. If the send
+    raises, the batch still releases its claims and its habits stay due. A crash of the process between the send and the write-back can still
+    re-send up to one batch on the next tick. With `HABITS_COALESCE_DIGEST` a
+    user's habits due together get one digest message. Habits overdue by more
+    than `HABITS_STALE_AFTER_SECONDS` follow `HABITS_STALE_POLICY`: `send` them
+    as usual, `skip` them or `collapse` them into one "missed" digest per user.
+    With `NOTIFICATIONS_USE_OUTBOX` reminders are enqueued to the outbox
+    instead of being sent inline. `lease` (a `single_flight` lease held by
+    the caller) is renewed after every batch. Returns the number of habits
+    processed.
+    """
+    batch_size = max(1, int(getattr(settings, 'HABITS_WRITEBACK_BATCH_SIZE', 500)))
+    use_outbox = getattr(settings, 'NOTIFICATIONS_USE_OUTBOX', False)
+    coalesce = getattr(settings, 'HABITS_COALESCE_DIGEST', False)
+    policy = stale_policy()
+    stale_cutoff = now - timedelta(seconds=int(getattr(settings, 'HABITS_STALE_AFTER_SECONDS', 3600)))
+    next_runs = {}
+    processed = 0
+    for chunk in _chunks(habits, batch_size, key=(lambda h: h.user_id) if coalesce else None):
+        metrics.inc('habits_scheduler_rows_scanned_total', len(chunk))
+        to_send, released = [], []
+        for h in chunk:
+            claimed = bool(h.claimed_by)
+            h.claimed_by, h.claimed_until = '', None
+
+            # Idempotency window
+            if h.last_notified_at and (now - h.last_notified_at).total_seconds() < IDEMPOTENCY_WINDOW_SECONDS:
+                # Too soon since the last notification; just give the claim back
+                if claimed:
+                    released.append(h)
+                continue
+            to_send.append(h)
+
+        fresh, stale = to_send, []
+        if policy != STALE_SEND:
+            fresh = [h for h in to_send if h.next_run_at > stale_cutoff]
+            stale = [h for h in to_send if h.next_run_at <= stale_cutoff]
+
+        # Habits missing from `results` are stale ones that are skipped on purpose
+        outbox, groups, results = [], [], {}
+        if use_outbox:
+            enqueue = fresh if policy == STALE_SKIP else to_send
+            outbox = [
+                NotificationOutbox(habit=h, scheduled_for=h.next_run_at, text=_reminder_text(h), next_attempt_at=now)
+                for h in enqueue
+            ]
+            results = {h.id: True for h in enqueue}
+        else:
+            groups = [(g, 'Напоминания о привычках:') for g in (_group_by_user(fresh) if coalesce else [[h] for h in fresh])]
+            if policy == STALE_COLLAPSE:
+                groups += [(g, 'Пропущенные напоминания:') for g in _group_by_user(stale)]
+
+        try:
+            if groups:
+                with metrics.timed('habits_scheduler_phase_seconds', phase='send'):
+                    results.update(_send_reminders(groups))
+        finally:
+            # Write back even if the send raised: claims are released and
+            # habits without a result keep their schedule and stay due
+            unsent = {h.id for g, _title in groups for h in g} - results.keys()
+            sent_habits = [h for h in to_send if h.id not in unsent]
+            chunk_processed = _advance(sent_habits, results, now, timezone.now(), next_runs, use_outbox)
+            with metrics.timed('habits_scheduler_phase_seconds', phase='writeback'):
+                write_back_dispatched(
+                    sent_habits + released + [h for h in to_send if h.id in unsent],
+                    outbox,
+                )
+            metrics.inc('habits_scheduler_rows_dispatched_total', chunk_processed)
+        processed += chunk_processed
+        if lease is not None:
+            lease.renew()
+    return processed
+
+
+class KeysetStream:
+    """Iterate a queryset in keyset pages of `page_size`, yielding at most `limit` rows.
+
+    Only one page is held in memory. Rows come in `order` (unique, e.g. ending
+    with `id`); after the stream stops, `cursor` holds the order values of the
+    last yielded row and `exhausted` tells whether the queryset ran out. With
+    `group` (a field of `order`, e.g. `user_id`) the stream only stops between
+    groups: the rows sharing the last row's `group` still come after `limit`.
+    """
+
+    def __init__(self, qs, order: tuple, page_size: int, limit: int, cursor=None, group: str | None = None):
+        self.qs = qs.order_by(*order)
+        self.order = order
+        self.page_size = max(1, page_size)
+        self.limit = limit
+        self.cursor = cursor
+        self.group = group
+        self.exhausted = False
+
+    def _after(self, cursor) -> Q:
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        q = Q()
+        for i, field in enumerate(self.order):
+            term = Q(**{f"{field}__gt": cursor[i]})
+            for prev, value in zip(self.order[:i], cursor[:i]):
+                term &= Q(**{prev: value})
+            q |= term
+        return q
+
+    def __iter__(self):
+        yielded = 0
+        while True:
+            qs, size = self.qs, min(self.page_size, self.limit - yielded)
+            finishing = yielded >= self.limit
+            if finishing:
+                if self.group is None or self.cursor is None:
+                    return
+                # Finish the last group, e.g. one user's digest, instead of splitting it across runs
+                qs = qs.filter(**{self.group: self.cursor[self.order.index(self.group)]})
+                size = self.page_size
+            page = qs if self.cursor is None else qs.filter(self._after(self.cursor))
+            with metrics.timed('habits_scheduler_phase_seconds', phase='query'):
+                rows = list(page[:size])
+            if not rows:
+                self.exhausted = not finishing
+                return
+            # Take the cursor before the rows are handed out: dispatching mutates them
+            cursor = [getattr(rows[-1], field) for field in self.order]
+            yield from rows
+            yielded += len(rows)
+            self.cursor = cursor
+            if len(rows) < size:
+                self.exhausted = not finishing
+                return
+
+
+def claim_due_habits(
+    worker_id: str,
+    now,
+    limit: int,
+    shard: int = 0,
+    shards: int = 1,
+    ids=None,
+) -> list[Habit]:
+    """Lease up to `limit` due habits to `worker_id` and return them.
+
+    Claims are disjoint between workers: on backends with
+    `SELECT ... FOR UPDATE SKIP LOCKED` (Postgres) candidate rows locked by
+    another worker are skipped, everywhere else the conditional UPDATE only
+    takes rows that are still unclaimed. With `shards > 1` only users with
+    `user_id % shards == shard` are considered; with `ids` only those habits.
+    Habits notified within `IDEMPOTENCY_WINDOW_SECONDS` are left for later:
+    `dispatch_habits` would only give them back.
     """
-    if now is None:
-        now = timezone.now()
-
-    # Build today's datetime at habit_time in the same timezone
-    tz = timezone.get_current_timezone()
-    today_dt = timezone.make_aware(
-        datetime(now.year, now.month, now.day, habit_time.hour, habit_time.minute, habit_time.second),
-        tz,
+    lease_seconds = int(getattr(settings, 'HABITS_CLAIM_LEASE_SECONDS', 300))
+    lease_until = now + timedelta(seconds=lease_seconds)
+    recent = now - timedelta(seconds=IDEMPOTENCY_WINDOW_SECONDS)
+
+    candidates = deliverable_habits().filter(
+        _unclaimed(now),
+        Q(last_notified_at__isnull=True) | Q(last_notified_at__lte=recent),
+        next_run_at__lte=now,
     )
+    if ids is not None:
+        candidates = candidates.filter(id__in=ids)
+    if shards > 1:
+        candidates = candidates.annotate(shard=Mod('user_id', shards)).filter(shard=shard)
+    candidates = candidates.order_by('next_run_at', 'id')
+
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True, of=('self',))
+        ids = list(candidates.values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        Habit.objects.filter(_unclaimed(now), id__in=ids).update(claimed_by=worker_id, claimed_until=lease_until)
 
-    # If today's time hasn't passed yet (including equality), schedule for today.
-    # Otherwise, move by `periodicity_days`.
-    if now <= today_dt:
-        return today_dt
-    return today_dt + timedelta(days=int(periodicity_days))
+    claimed = list(
+        deliverable_habits()
+        .filter(id__in=ids, claimed_by=worker_id, claimed_until=lease_until)
+        .order_by('next_run_at', 'id')
+    )
+    if len(claimed) < len(ids):
+        # Unlinked or made public since the candidate select: give those back
+        Habit.objects.filter(id__in=set(ids) - {h.id for h in claimed}, claimed_by=worker_id).update(
+            claimed_by='', claimed_until=None,
+        )
+    return claimed
 
 
 @shared_task
-def check_and_notify_due_habits():
+def dispatch_due_habits_shard(shard: int = 0, shards: int = 1) -> int:
+    """Claim-mode worker: claim chunks of due habits in `shard` and dispatch them.
+
+    Any number of copies may run concurrently; each chunk is leased to a
+    single worker, so habits are never sent twice. The loop stops when
+    nothing is left to claim or a claimed chunk moves nothing forward.
+    """
+    worker_id = _worker_id()
+    limit = max(1, int(getattr(settings, 'HABITS_CLAIM_BATCH_SIZE', 500)))
+    now = timezone.now()
+
+    total = 0
+    while True:
+        with metrics.timed('habits_scheduler_phase_seconds', phase='claim'):
+            claimed = claim_due_habits(worker_id, now, limit, shard=shard, shards=shards)
+        if not claimed:
+            break
+        processed = dispatch_habits(claimed, now)
+        if not processed:
+            break
+        total += processed
+    return total
+
+
+def dispatch_spread(habits, now, token: str | None = None, lease=None) -> int:
+    """Dispatch `habits` spread over `HABITS_SPREAD_WINDOW_SECONDS` (peak smoothing).
+
+    Each chunk of `HABITS_WRITEBACK_BATCH_SIZE` habits is split into slots by
+    a stable offset from the start of the current minute, so a spike of
+    identical times becomes a flat stream of slots and no reminder leaves its
+    minute. A run that starts late in the minute squeezes the slots into the
+    part of the window still ahead instead of sending the passed ones at once. The offset comes from the habit id, or from the user id with
+    `HABITS_COALESCE_DIGEST` so a user's habits still share one digest. Slots
+    already due are sent inline; later ones are leased (`claimed_by`) and
+    handed to `dispatch_spread_slot` with an ETA, so the scheduler run never
+    sleeps while it holds its lease. Habits already claimed by `token` keep
+    that claim; `lease` is renewed after every chunk. Without a window this
+    is `dispatch_habits`.
+    """
+    window = spread_window()
+    if window <= 1:
+        return dispatch_habits(habits, now, lease)
+
+    coalesce = getattr(settings, 'HABITS_COALESCE_DIGEST', False)
+    batch_size = max(1, int(getattr(settings, 'HABITS_WRITEBACK_BATCH_SIZE', 500)))
+    claim_lease = timedelta(seconds=int(getattr(settings, 'HABITS_CLAIM_LEASE_SECONDS', 300)))
+    if token is None:
+        token = f"spread:{uuid.uuid4().hex[:16]}"
+    start = now.replace(second=0, microsecond=0)
+    left = max(0.0, (start + timedelta(seconds=window) - now).total_seconds())
+
+    def offset(h):
+        return spread_offset(h.user_id if coalesce else h.id, window)
+
+    def slot_time(slot_offset):
+        if left >= window:
+            return start + timedelta(seconds=slot_offset)
+        return now + timedelta(seconds=slot_offset * left / window)
+
+    processed = 0
+    # Only one chunk of the (possibly streamed) habits is held at a time
+    for chunk in _chunks(habits, batch_size, key=(lambda h: h.user_id) if coalesce else None):
+        slots: dict[int, list[Habit]] = {}
+        for h in chunk:
+            slots.setdefault(offset(h), []).append(h)
+        for slot_offset in sorted(slots):
+            slot = slots[slot_offset]
+            at = slot_time(slot_offset)
+            if at <= timezone.now() or not _defer_slot(slot, at, token, at + claim_lease):
+                processed += dispatch_habits(slot, timezone.now())
+            else:
+                processed += len(slot)
+        if lease is not None:
+            lease.renew()
+    return processed
+
+
+def _defer_slot(slot, at, token: str, lease_until) -> bool:
+    """Lease the habits of `slot` to `token` and schedule their dispatch at `at`."""
+    ids = [h.id for h in slot]
+    Habit.objects.filter(Q(claimed_by=token) | _unclaimed(timezone.now()), id__in=ids).update(
+        claimed_by=token, claimed_until=lease_until,
+    )
+    try:
+        dispatch_spread_slot.apply_async((ids, token), eta=at)
+    except Exception as e:
+        logger.warning("Could not schedule a spread slot, sending it now: %s", e)
+        Habit.objects.filter(id__in=ids, claimed_by=token).update(claimed_by='', claimed_until=None)
+        return False
+    return True
+
+
+@shared_task
+def dispatch_spread_slot(ids, token: str) -> int:
+    """Send one slot deferred by `dispatch_spread` (habits leased to `token`)."""
+    now = timezone.now()
+    habits = list(
+        deliverable_habits()
+        .filter(id__in=ids, claimed_by=token, next_run_at__lte=now)
+        .order_by('user_id', 'id')
+    )
+    processed = dispatch_habits(habits, now)
+    # Habits that were edited or unlinked in the meantime just get their lease back
+    Habit.objects.filter(id__in=ids, claimed_by=token).update(claimed_by='', claimed_until=None)
+    return processed
+
+
+def dispatch_occurrences(now, lease=None) -> tuple[int, bool]:
+    """Dispatch the habits in the minute buckets up to `now` (`HABITS_USE_OCCURRENCES`).
+
+    Consumed buckets are deleted; habits that were not sent get a bucket for
+    their next attempt. `lease` is renewed between batches. Returns
+    `(processed, more)`.
+    """
+    limit = max(1, int(getattr(settings, 'HABITS_MAX_PER_RUN', 10000)))
+    with metrics.timed('habits_scheduler_phase_seconds', phase='query'):
+        due = occurrences.due_occurrences(now, limit)
+    if not due:
+        return 0, False
+    habit_ids = {habit_id for _, habit_id in due}
+    deliverable_ids = set(deliverable_habits().filter(id__in=habit_ids).values_list('id', flat=True))
+    worker_id = _worker_id()
+    # Claimed like everywhere else, so run_scheduler can't send the same habits meanwhile
+    with metrics.timed('habits_scheduler_phase_seconds', phase='claim'):
+        habits = claim_due_habits(worker_id, now, len(habit_ids), ids=habit_ids)
+    habits.sort(key=lambda h: (h.user_id, h.id))
+    processed = dispatch_spread(habits, now, token=worker_id, lease=lease)
+    HabitOccurrence.objects.filter(id__in=[occurrence_id for occurrence_id, _ in due]).delete()
+    occurrences.requeue(habit_ids, deliverable_ids, now)
+    return processed, len(due) == limit
+
+
+@shared_task
+def roll_habit_occurrences() -> dict:
+    """Daily: extend the occurrence table up to the horizon and purge old buckets."""
+    return occurrences.roll_forward()
+
+
+@shared_task
+def check_and_notify_due_habits(cursor=None):
     """Select due habits and send Telegram notifications.
 
     Rules:
     - Skip public templates and any habits owned by the `public` user.
+    - Skip habits of users without a linked Telegram chat before doing any work.
     - Use a small idempotency window to avoid duplicates if the task overlaps.
-    - After sending, update `last_notified_at` and recalc `next_run_at`.
-    - If `next_run_at` is null, initialize it via `calc_next_run`.
+    - After sending, update `last_notified_at` and recalc `next_run_at`;
+      the updates are written back in batches of `HABITS_WRITEBACK_BATCH_SIZE`.
+    - `next_run_at` is kept up to date by every write to a habit (see `Habit.save`),
+      so there is no initialization pass here.
+    - With `HABITS_CLAIM_MODE` the due habits are not sent here: the work is
+      fanned out to `HABITS_SCHEDULER_SHARDS` claim workers instead.
+    - Due habits are streamed in keyset pages; one run handles at most
+      `HABITS_MAX_PER_RUN` of them and re-enqueues itself with `cursor` to
+      continue a large backlog (e.g. after downtime).
+    - With `HABITS_USE_OCCURRENCES` the due habits are read from the minute
+      buckets of `HabitOccurrence` instead of scanning `Habit.next_run_at`.
+      While the buckets are missing (the flag was just switched on) the
+      scan is used and `roll_habit_occurrences` is enqueued to build them.
+    - With `HABITS_SPREAD_WINDOW_SECONDS` the sends are spread over the
+      minute by a stable per-habit (per-user with digests) offset; later
+      slots go to `dispatch_spread_slot` (see `dispatch_spread`).
+    - Single flight: a tick that starts while the previous run still holds
+      the `SCHEDULER_LEASE` lease exits immediately (counted as `contended`).
+      The run renews the lease after every batch, however long it takes.
     """
-    now = timezone.now()
-    window_seconds = 90
+    if cursor is None and getattr(settings, 'HABITS_CLAIM_MODE', False):
+        shards = max(1, int(getattr(settings, 'HABITS_SCHEDULER_SHARDS', 1)))
+        for shard in range(shards):
+            dispatch_due_habits_shard.delay(shard, shards)
+        return
 
-    qs = (
-        Habit.objects
-        .select_related('user')
-        .filter(is_public=False)
-        .exclude(user__username='public')
-    )
+    with single_flight(SCHEDULER_LEASE) as lease:
+        if not lease:
+            metrics.inc('habits_scheduler_ticks_total', outcome='skipped')
+            logger.info("Previous scheduler run is still in progress, skipping this tick")
+            return
+        metrics.inc('habits_scheduler_ticks_total', outcome='run')
+        with metrics.timed('habits_scheduler_phase_seconds', phase='tick'):
+            processed, more, next_cursor = _scan_due_habits(timezone.now(), cursor, lease)
 
-    # Initialize next_run_at for habits where it's not set
-    to_init = qs.filter(next_run_at__isnull=True)
-    for h in to_init:
-        h.next_run_at = calc_next_run(h.time, h.periodicity_days, now=now)
-        h.save(update_fields=['next_run_at'])
-
-    # Now pick due habits
-    due = qs.filter(next_run_at__lte=now)
-    for h in due:
-        # Idempotency window
-        if h.last_notified_at and (now - h.last_notified_at).total_seconds() < window_seconds:
-            # Too soon since the last notification
-            continue
+    # Continue only after the lease is released, so the continuation is not skipped
+    if more:
+        logger.info("Processed %s due habits, continuing the backlog in a new run", processed)
+        check_and_notify_due_habits.delay(cursor=next_cursor)
 
-        # Prepare message
-        time_str = h.time.strftime('%H:%M') if h.time else ''
-        place_str = f" в месте: {h.place}" if h.place else ''
-        text = f"Напоминание о привычке:\n• {h.action}{place_str}\n⏰ {time_str}"
 
-        sent = send_telegram_message(h.user, text)
-        # Regardless of sent result, move the schedule to avoid spamming
-        h.last_notified_at = now if sent else h.last_notified_at or now
-        # Advance reference time by 1 second to ensure next run moves to the future day
-        h.next_run_at = calc_next_run(h.time, h.periodicity_days, now=now + timedelta(seconds=1))
-        h.save(update_fields=['last_notified_at', 'next_run_at'])
+def _claimed_pages(stream, worker_id: str, now, page_size: int, coalesce: bool):
+    """Claim the streamed due habits page by page and yield the claimed rows.
+
+    Another scheduler (`run_scheduler`, a claim worker) may take the same
+    rows meanwhile; only the habits actually leased to `worker_id` are sent.
+    """
+    for page in _chunks(stream, page_size, key=(lambda h: h.user_id) if coalesce else None):
+        with metrics.timed('habits_scheduler_phase_seconds', phase='claim'):
+            claimed = claim_due_habits(worker_id, now, len(page), ids=[h.id for h in page])
+        if coalesce:
+            claimed.sort(key=lambda h: (h.user_id, h.id))
+        yield from claimed
+
+
+def _scan_due_habits(now, cursor=None, lease=None) -> tuple[int, bool, list | None]:
+    """One bounded pass of `check_and_notify_due_habits`: `(processed, more, next cursor)`.
+
+    `lease` (the `SCHEDULER_LEASE` held by the run) is renewed after every batch.
+    """
+    coalesce = getattr(settings, 'HABITS_COALESCE_DIGEST', False)
+
+    if cursor is None:
+        if getattr(settings, 'HABITS_USE_OCCURRENCES', False):
+            if not occurrences.buckets_missing(now):
+                processed, more = dispatch_occurrences(now, lease)
+                return processed, more, None
+            # Just switched on: scan next_run_at until the buckets are built
+            logger.warning("Occurrence buckets are missing, materializing them; scanning next_run_at meanwhile")
+            try:
+                roll_habit_occurrences.delay()
+            except Exception as e:
+                logger.warning("Could not enqueue roll_habit_occurrences: %s", e)
+    elif not coalesce:
+        cursor = [parse_datetime(cursor[0]), cursor[1]]
+
+    # Now pick due habits of linked users (skipping the ones currently leased by claim workers)
+    due = deliverable_habits().filter(_unclaimed(now), next_run_at__lte=now)
+    page_size = max(1, int(getattr(settings, 'HABITS_WRITEBACK_BATCH_SIZE', 500)))
+    stream = KeysetStream(
+        # The page only finds candidates; the rows are loaded by the claim
+        due.select_related(None).only('id', 'user_id', 'next_run_at'),
+        # Keep each user's habits next to each other so they land in one digest
+        order=('user_id', 'id') if coalesce else ('next_run_at', 'id'),
+        page_size=page_size,
+        limit=max(1, int(getattr(settings, 'HABITS_MAX_PER_RUN', 10000))),
+        cursor=cursor,
+        group='user_id' if coalesce else None,
+    )
+    worker_id = _worker_id()
+    pages = _claimed_pages(stream, worker_id, now, page_size, coalesce)
+    processed = dispatch_spread(pages, now, token=worker_id, lease=lease)
+
+    if stream.exhausted:
+        return processed, False, None
+    next_cursor = list(stream.cursor)
+    if not coalesce:
+        next_cursor[0] = next_cursor[0].isoformat()
+    return processed, True, next_cursor
@@ -0,0 +1,59 @@
+"""Backend selection for the Redis-backed helpers (scheduler leases, metrics, Telegram rate limits).
+
+Each helper has a `redis` backend shared by all processes and a `local` one
+that only covers the current process (development and tests; pytest forces
+it in settings). The choice comes from a `*_BACKEND` setting, '' turns the
+helper off. Helpers pointing to the same Redis URL share one client and so
+one connection pool.
+"""
+from __future__ import annotations
+
+import threading
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_clients: dict = {}
+_backends: dict = {}
+
+
+def redis_client(url: str):
+    """Shared `redis.Redis` client (and connection pool) for `url`."""
+    with _lock:
+        client = _clients.get(url)
+        if client is None:
+            import redis
+
+            client = _clients[url] = redis.Redis.from_url(url)
+        return client
+
+
+def get_backend(setting: str, url_setting: str, local, remote):
+    """Return the backend selected by `settings.<setting>`, or None when it is off.
+
+    `local()` or `remote(client)` is built once per process and reused; the
+    Redis URL comes from `settings.<url_setting>` (default: the Celery broker).
+    """
+    backend = getattr(settings, setting, 'local')
+    if not backend:
+        return None
+    with _lock:
+        instance = _backends.get(setting)
+    if instance is not None:
+        return instance
+    if backend == 'redis':
+        instance = remote(redis_client(getattr(settings, url_setting, settings.CELERY_BROKER_URL)))
+    else:
+        instance = local()
+    with _lock:
+        return _backends.setdefault(setting, instance)
+
+
+def reset() -> None:
+    """Forget all backends and Redis clients; they are rebuilt on next use."""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _backends.clear()
+    for client in clients:
+        client.close()
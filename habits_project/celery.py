@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import task_postrun
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'habits_project.settings')
 
@@ -8,6 +9,14 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    # Push the metrics buffered by the task to the shared store
+    from . import metrics
+
+    metrics.flush()
+
+
 @app.task(bind=True)
 def debug_task(self):  # pragma: no cover
     print(f'Request: {self.request!r}')
@@ -0,0 +1,192 @@
+"""Scheduler and Telegram metrics with Prometheus text exposition.
+
+No collector library is needed: counters and histograms are accumulated in
+the process and exposed as Prometheus text by `GET /metrics/` and by the
+`scheduler_metrics` management command. With the `redis` backend every
+process (Celery workers, `run_scheduler`, web) buffers its increments and
+flushes them into one Redis hash, so the numbers are cluster-wide; `local`
+keeps them per process and is meant for development and tests.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600, 6 * 3600, 24 * 3600)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'habits_dispatch_lag_seconds': (
+        'histogram', 'Delay between next_run_at and the actual send', LAG_BUCKETS),
+    'habits_scheduler_phase_seconds': (
+        'histogram', 'Duration of scheduler phases (tick, query, claim, send, writeback)', DURATION_BUCKETS),
+    'habits_scheduler_rows_scanned_total': (
+        'counter', 'Due habits read by the scheduler', None),
+    'habits_scheduler_rows_dispatched_total': (
+        'counter', 'Due habits sent, enqueued or rescheduled by the scheduler', None),
+    'habits_scheduler_ticks_total': (
+        'counter', 'Scheduler ticks by outcome (run, skipped while another run held the lease)', None),
+    'notifications_outbox_deliveries_total': (
+        'counter', 'Outbox delivery attempts by outcome', None),
+    'telegram_link_tokens_purged_total': (
+        'counter', 'Used and expired Telegram link codes deleted by purge_telegram_link_tokens', None),
+    'telegram_request_seconds': (
+        'histogram', 'Bot API request latency by method (long-polling getUpdates excluded)', DURATION_BUCKETS),
+    'telegram_errors_total': (
+        'counter', 'Failed Bot API requests by reason (flood, rate_limited, api, network)', None),
+}
+
+_REDIS_KEY = 'metrics'
+
+
+def _series(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class LocalMetrics:
+    """Counters of the current process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def add(self, series: tuple, value: float) -> None:
+        with self._lock:
+            self._values[series] = self._values.get(series, 0.0) + value
+
+    def flush(self) -> None:
+        pass
+
+    def snapshot(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class RedisMetrics(LocalMetrics):
+    """Increments are buffered in the process and added to a shared Redis hash on `flush()`."""
+
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._values = self._values, {}
+        if not pending:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for (name, labels), value in pending.items():
+            pipe.hincrbyfloat(_REDIS_KEY, json.dumps([name, labels]), value)
+        pipe.execute()
+
+    def snapshot(self) -> dict[tuple, float]:
+        self.flush()
+        values = {}
+        for field, value in self._client.hgetall(_REDIS_KEY).items():
+            name, labels = json.loads(field)
+            values[(name, tuple(tuple(pair) for pair in labels))] = float(value)
+        return values
+
+
+def get_registry():
+    """Return the configured metrics backend, or None when metrics are off."""
+    return get_backend('METRICS_BACKEND', 'METRICS_REDIS_URL', LocalMetrics, RedisMetrics)
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    registry = get_registry()
+    if registry is not None and value:
+        registry.add(_series(name, labels), value)
+
+
+def observe(name: str, value: float, **labels) -> None:
+    """Add `value` to histogram `name` (cumulative `le` buckets, `_sum`, `_count`)."""
+    registry = get_registry()
+    if registry is None:
+        return
+    for le in METRICS[name][2]:
+        if value <= le:
+            registry.add(_series(f"{name}_bucket", {**labels, 'le': le}), 1)
+    registry.add(_series(f"{name}_bucket", {**labels, 'le': '+Inf'}), 1)
+    registry.add(_series(f"{name}_sum", labels), value)
+    registry.add(_series(f"{name}_count", labels), 1)
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """Observe the duration of the block in histogram `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def flush() -> None:
+    """Push buffered increments to the shared store (no-op for `local`)."""
+    registry = get_registry()
+    if registry is None:
+        return
+    try:
+        registry.flush()
+    except Exception as e:
+        # Metrics must never break reminders
+        logger.warning("Metrics store unavailable: %s", e)
+
+
+def snapshot() -> dict[tuple, float]:
+    registry = get_registry()
+    return registry.snapshot() if registry is not None else {}
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def _sort_key(item):
+    (_name, labels), _value = item
+    # Buckets in numeric order of `le`, +Inf last
+    le = dict(labels).get('le')
+    return tuple(pair for pair in labels if pair[0] != 'le'), math.inf if le in (None, '+Inf') else float(le)
+
+
+def render_text(values: dict | None = None) -> str:
+    """Render `values` (default: the current snapshot) in the Prometheus text format."""
+    if values is None:
+        values = snapshot()
+    lines = []
+    for name, (kind, help_text, _buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        suffixes = ('_bucket', '_sum', '_count') if kind == 'histogram' else ('',)
+        for suffix in suffixes:
+            series = [item for item in values.items() if item[0][0] == name + suffix]
+            for (series_name, labels), value in sorted(series, key=_sort_key):
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"{series_name}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{series_name} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """`GET /metrics/` for Prometheus: `Authorization: Bearer <METRICS_TOKEN>` or a staff session."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = bool(token) and request.headers.get('Authorization') == f"Bearer {token}"
+    if not (authorized or (request.user.is_authenticated and request.user.is_staff)):
+        return HttpResponseForbidden()
+    return HttpResponse(render_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
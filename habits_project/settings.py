@@ -162,9 +162,108 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': 60.0,  # every minute
         # Alternatively: 'schedule': crontab(),
     },
+    'purge-telegram-link-tokens': {
+        'task': 'notifications.tasks.purge_telegram_link_tokens',
+        'schedule': crontab(minute=15),  # hourly
+    },
+    'purge-telegram-webhook-updates': {
+        'task': 'notifications.tasks.purge_telegram_webhook_updates',
+        'schedule': crontab(minute=20),  # hourly
+    },
 }
 
 
+# Habits scheduler
+# Dispatched habits are written back (last_notified_at/next_run_at) in batches of this size; a crashed
+# worker re-sends up to one batch
+HABITS_WRITEBACK_BATCH_SIZE = env.int('HABITS_WRITEBACK_BATCH_SIZE', default=500)
+# Claim mode: the beat task fans out to shard workers that lease disjoint chunks of due habits
+HABITS_CLAIM_MODE = env.bool('HABITS_CLAIM_MODE', default=False)
+HABITS_SCHEDULER_SHARDS = env.int('HABITS_SCHEDULER_SHARDS', default=1)
+HABITS_CLAIM_BATCH_SIZE = env.int('HABITS_CLAIM_BATCH_SIZE', default=500)
+HABITS_CLAIM_LEASE_SECONDS = env.int('HABITS_CLAIM_LEASE_SECONDS', default=300)
+# One digest message per user for all of their habits due in the same tick
+HABITS_COALESCE_DIGEST = env.bool('HABITS_COALESCE_DIGEST', default=False)
+# Catch-up after downtime: due habits are streamed, one run handles at most this many and continues in a new run
+HABITS_MAX_PER_RUN = env.int('HABITS_MAX_PER_RUN', default=10000)
+# Occurrences overdue by more than this are 'send' (as usual), 'skip' (reschedule silently)
+# or 'collapse' (one "missed" digest per user); an unknown value is logged and treated as 'send'
+HABITS_STALE_AFTER_SECONDS = env.int('HABITS_STALE_AFTER_SECONDS', default=3600)
+HABITS_STALE_POLICY = env('HABITS_STALE_POLICY', default='send')
+# Peak smoothing: spread sends of the same minute over this many seconds by a stable per-habit
+# (per-user with HABITS_COALESCE_DIGEST) offset; later slots run as ETA tasks (0 = off, max 60)
+HABITS_SPREAD_WINDOW_SECONDS = env.int('HABITS_SPREAD_WINDOW_SECONDS', default=0)
+# Materialized upcoming occurrences (HabitOccurrence): the scheduler reads the current minute bucket
+HABITS_USE_OCCURRENCES = env.bool('HABITS_USE_OCCURRENCES', default=False)
+HABITS_OCCURRENCE_HORIZON_DAYS = env.int('HABITS_OCCURRENCE_HORIZON_DAYS', default=7)
+# Single-flight lease of check_and_notify_due_habits: 'redis' (shared by workers), 'local' (per process), '' disables
+HABITS_SCHEDULER_LOCK_BACKEND = env('HABITS_SCHEDULER_LOCK_BACKEND', default='redis')
+HABITS_SCHEDULER_LOCK_REDIS_URL = env('HABITS_SCHEDULER_LOCK_REDIS_URL', default=CELERY_BROKER_URL)
+# Expires a lease left behind by a crashed run; a live run renews it after every batch, so it
+# only has to exceed the longest batch
+HABITS_SCHEDULER_LOCK_TTL_SECONDS = env.int('HABITS_SCHEDULER_LOCK_TTL_SECONDS', default=300)
+
+# Metrics (GET /metrics/, manage.py scheduler_metrics): 'redis' aggregates all processes, 'local' is per process, '' disables
+METRICS_BACKEND = env('METRICS_BACKEND', default='redis')
+METRICS_REDIS_URL = env('METRICS_REDIS_URL', default=CELERY_BROKER_URL)
+# Bearer token for scrapers; without it only staff sessions can read /metrics/
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
+# Outbox: the scheduler only enqueues reminders, `drain_notification_outbox` delivers them
+NOTIFICATIONS_USE_OUTBOX = env.bool('NOTIFICATIONS_USE_OUTBOX', default=False)
+NOTIFICATIONS_OUTBOX_BATCH_SIZE = env.int('NOTIFICATIONS_OUTBOX_BATCH_SIZE', default=100)
+NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS = env.int('NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS', default=5)
+NOTIFICATIONS_OUTBOX_BACKOFF_SECONDS = env.int('NOTIFICATIONS_OUTBOX_BACKOFF_SECONDS', default=30)
+NOTIFICATIONS_OUTBOX_LEASE_SECONDS = env.int('NOTIFICATIONS_OUTBOX_LEASE_SECONDS', default=120)
+if HABITS_SPREAD_WINDOW_SECONDS > 0:
+    # Slots are offsets from the start of the minute: tick at :00 rather than 60 s after beat started
+    CELERY_BEAT_SCHEDULE['check-and-notify-due-habits']['schedule'] = crontab()
+
+if HABITS_USE_OCCURRENCES:
+    CELERY_BEAT_SCHEDULE['roll-habit-occurrences'] = {
+        'task': 'habits.tasks.roll_habit_occurrences',
+        'schedule': crontab(minute=5, hour=0),
+    }
+
+if NOTIFICATIONS_USE_OUTBOX:
+    CELERY_BEAT_SCHEDULE['drain-notification-outbox'] = {
+        'task': 'notifications.tasks.drain_notification_outbox',
+        'schedule': 10.0,
+    }
+
+
 # Telegram
 TELEGRAM_BOT_TOKEN = env('TELEGRAM_BOT_TOKEN', default='')
 TELEGRAM_CHAT_ID = env('TELEGRAM_CHAT_ID', default='')
+# Bot API base URL; point it to `manage.py fake_telegram_api` for offline load tests
+TELEGRAM_API_BASE = env('TELEGRAM_API_BASE', default='https://api.telegram.org')
+# secret_token for setWebhook; the webhook view rejects requests without it (empty disables the webhook)
+TELEGRAM_WEBHOOK_SECRET = env('TELEGRAM_WEBHOOK_SECRET', default='')
+# update_ids taken by the webhook are remembered this long to skip Telegram's re-deliveries
+TELEGRAM_WEBHOOK_DEDUP_HOURS = env.int('TELEGRAM_WEBHOOK_DEDUP_HOURS', default=24)
+# Used/expired link codes are kept this long, then purged hourly in chunks (purge_telegram_link_tokens;
+# the chunk limits also apply to purge_telegram_webhook_updates)
+TELEGRAM_LINK_TOKEN_RETENTION_HOURS = env.int('TELEGRAM_LINK_TOKEN_RETENTION_HOURS', default=24)
+TELEGRAM_LINK_TOKEN_PURGE_CHUNK_SIZE = env.int('TELEGRAM_LINK_TOKEN_PURGE_CHUNK_SIZE', default=1000)
+TELEGRAM_LINK_TOKEN_PURGE_MAX_CHUNKS = env.int('TELEGRAM_LINK_TOKEN_PURGE_MAX_CHUNKS', default=100)
+# Polled updates are committed together with the shared offset in chunks of this size
+TELEGRAM_UPDATES_CHUNK_SIZE = env.int('TELEGRAM_UPDATES_CHUNK_SIZE', default=20)
+# Shared keep-alive HTTP clients for the Bot API (notifications.telegram)
+TELEGRAM_CONNECT_TIMEOUT = env.float('TELEGRAM_CONNECT_TIMEOUT', default=5)
+TELEGRAM_READ_TIMEOUT = env.float('TELEGRAM_READ_TIMEOUT', default=10)
+TELEGRAM_POOL_SIZE = env.int('TELEGRAM_POOL_SIZE', default=20)
+TELEGRAM_CONNECT_RETRIES = env.int('TELEGRAM_CONNECT_RETRIES', default=3)
+# Max sendMessage requests in flight when a batch of reminders is sent concurrently
+TELEGRAM_SEND_CONCURRENCY = env.int('TELEGRAM_SEND_CONCURRENCY', default=20)
+# Rate limits of the Bot API: 'redis' shares the buckets between workers, 'local' is per process, '' disables
+TELEGRAM_RATE_LIMIT_BACKEND = env('TELEGRAM_RATE_LIMIT_BACKEND', default='redis')
+TELEGRAM_RATE_LIMIT_REDIS_URL = env('TELEGRAM_RATE_LIMIT_REDIS_URL', default=CELERY_BROKER_URL)
+TELEGRAM_GLOBAL_RATE = env.float('TELEGRAM_GLOBAL_RATE', default=30)
+TELEGRAM_PER_CHAT_RATE = env.float('TELEGRAM_PER_CHAT_RATE', default=1)
+# Longer waits are not slept through: the message is rescheduled instead
+TELEGRAM_RATE_LIMIT_MAX_WAIT = env.float('TELEGRAM_RATE_LIMIT_MAX_WAIT', default=5)
+# No Redis under pytest
+if ('PYTEST_CURRENT_TEST' in os.environ) or any(m.startswith('pytest') for m in sys.modules.keys()):
+    TELEGRAM_RATE_LIMIT_BACKEND = 'local'
+    HABITS_SCHEDULER_LOCK_BACKEND = 'local'
+    METRICS_BACKEND = 'local'
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
+from habits_project.metrics import metrics_view
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -18,6 +19,9 @@ urlpatterns = [
     path('api/', include('habits.urls', namespace='habits')),
     path('api/', include(('notifications.urls', 'notifications'), namespace='notifications')),
 
+    # Prometheus metrics of the scheduler and Telegram client
+    path('metrics/', metrics_view, name='metrics'),
+
     # Schema & docs
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/docs/swagger/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
@@ -1,6 +1,12 @@
 from django.contrib import admin
 
-from .models import TelegramProfile, TelegramLinkToken
+from .models import (
+    NotificationOutbox,
+    TelegramLinkToken,
+    TelegramProfile,
+    TelegramUpdateOffset,
+    TelegramWebhookUpdate,
+)
 
 
 @admin.register(TelegramProfile)
@@ -18,3 +24,24 @@ class TelegramLinkTokenAdmin(admin.ModelAdmin):
     list_filter = ('used_at',)
     raw_id_fields = ('user',)
     ordering = ('-created_at',)
+
+
+@admin.register(NotificationOutbox)
+class NotificationOutboxAdmin(admin.ModelAdmin):
+    list_display = ('id', 'habit', 'scheduled_for', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    search_fields = ('habit__action', 'habit__user__username', 'last_error')
+    list_filter = ('status',)
+    raw_id_fields = ('habit',)
+    ordering = ('-scheduled_for',)
+
+
+@admin.register(TelegramUpdateOffset)
+class TelegramUpdateOffsetAdmin(admin.ModelAdmin):
+    list_display = ('name', 'update_id', 'updated_at')
+
+
+@admin.register(TelegramWebhookUpdate)
+class TelegramWebhookUpdateAdmin(admin.ModelAdmin):
+    list_display = ('update_id', 'received_at')
+    search_fields = ('update_id',)
+    ordering = ('-received_at',)
@@ -0,0 +1,197 @@
+"""A small local stand-in for the Telegram Bot API, for offline load and latency tests.
+
+Implements `sendMessage` and `getUpdates` (with long polling) under the real
+`/bot<token>/<method>` paths, so it is enough to point `TELEGRAM_API_BASE` at
+it. Latency, server errors, random 429 floods and a per-chat rate limit can be
+injected. Two extra endpoints are not part of the Bot API:
+
+- `GET /stats` returns the counters as JSON;
+- `POST /updates` with `{"chat_id": ..., "text": ...}` queues an incoming
+  message for `getUpdates`.
+
+Run it with `python manage.py fake_telegram_api`.
+"""
+from __future__ import annotations
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+_METHOD_PATH = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+
+
+class FakeBotAPI:
+    """State and behaviour of the fake server; thread-safe."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+        chat_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_rate = chat_rate
+        self.counters: Counter = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._updates_ready = threading.Condition(self._lock)
+        self._updates: list[dict] = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._chat_last_sent: dict[int, float] = {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+    def push_update(self, chat_id: int, text: str) -> dict:
+        """Queue an incoming private message, as if a user wrote to the bot."""
+        with self._updates_ready:
+            update = {
+                'update_id': self._next_update_id,
+                'message': {
+                    'message_id': self._next_update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Fake'},
+                    'text': text,
+                },
+            }
+            self._next_update_id += 1
+            self._updates.append(update)
+            self.counters['updates_queued'] += 1
+            self._updates_ready.notify_all()
+        return update
+
+    def handle(self, method: str, params: dict) -> tuple[int, dict]:
+        """Answer a Bot API call: `(HTTP status, JSON body)`."""
+        with self._lock:
+            self.counters['requests'] += 1
+            self.counters[f"method:{method}"] += 1
+            roll = self._random.random()
+        if method == 'getUpdates':
+            # Long polling waits for updates, not for the injected latency
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+
+        if self.latency:
+            time.sleep(self.latency)
+        if roll < self.error_rate:
+            return self._fail(500, 'Internal Server Error', 'error')
+        if roll < self.error_rate + self.flood_rate:
+            return self._flood(self.retry_after)
+        if method != 'sendMessage':
+            return self._fail(404, 'Not Found: method not found', 'error')
+
+        try:
+            chat_id = int(params['chat_id'])
+        except (KeyError, TypeError, ValueError):
+            return self._fail(400, 'Bad Request: chat_id is empty', 'error')
+        with self._lock:
+            if self.chat_rate:
+                now = time.monotonic()
+                wait = self._chat_last_sent.get(chat_id, float('-inf')) + 1 / self.chat_rate - now
+                if wait > 0:
+                    self.counters['flood'] += 1
+                    return 429, self._flood_body(max(1, int(wait + 0.999)))
+                self._chat_last_sent[chat_id] = now
+            message_id = self._next_message_id
+            self._next_message_id += 1
+            self.counters['sent'] += 1
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }}
+
+    def _get_updates(self, params: dict) -> list[dict]:
+        offset = int(params.get('offset') or 0)
+        limit = max(1, min(100, int(params.get('limit') or 100)))
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self._updates_ready:
+            # Like Telegram, an offset confirms (drops) every earlier update
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def _flood(self, retry_after: int) -> tuple[int, dict]:
+        with self._lock:
+            self.counters['flood'] += 1
+        return 429, self._flood_body(retry_after)
+
+    @staticmethod
+    def _flood_body(retry_after: int) -> dict:
+        return {
+            'ok': False,
+            'error_code': 429,
+            'description': f'Too Many Requests: retry after {retry_after}',
+            'parameters': {'retry_after': retry_after},
+        }
+
+    def _fail(self, status: int, description: str, counter: str) -> tuple[int, dict]:
+        with self._lock:
+            self.counters[counter] += 1
+        return status, {'ok': False, 'error_code': status, 'description': description}
+
+
+def _make_handler(api: FakeBotAPI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self._dispatch()
+
+        def do_POST(self):
+            self._dispatch()
+
+        def _dispatch(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query))
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                body = self.rfile.read(length)
+                try:
+                    params.update(json.loads(body) if body.strip() else {})
+                except ValueError:
+                    params.update(parse_qsl(body.decode('utf-8', 'replace')))
+
+            if url.path == '/stats':
+                return self._reply(200, api.stats())
+            if url.path == '/updates' and self.command == 'POST':
+                return self._reply(200, api.push_update(int(params['chat_id']), params.get('text', '')))
+            match = _METHOD_PATH.match(url.path)
+            if match is None:
+                return self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            self._reply(*api.handle(match['method'], params))
+
+        def _reply(self, status: int, body: dict):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def make_server(api: FakeBotAPI, host: str = '127.0.0.1', port: int = 8081) -> ThreadingHTTPServer:
+    """HTTP server for `api`; `port=0` picks a free port (see `server.server_address`)."""
+    server = ThreadingHTTPServer((host, port), _make_handler(api))
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from notifications.fake_api import FakeBotAPI, make_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local fake Telegram Bot API (sendMessage, getUpdates) with injectable latency, "
+        "errors and 429 floods. Point TELEGRAM_API_BASE at it to load-test offline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay of every call except getUpdates')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of calls answered with HTTP 500')
+        parser.add_argument('--flood-rate', type=float, default=0.0, help='Share of calls answered with 429')
+        parser.add_argument('--retry-after', type=int, default=1, help='retry_after of random 429 answers')
+        parser.add_argument('--chat-rate', type=float, default=0.0, help='Messages/s per chat before 429 (0 = no limit)')
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        api = FakeBotAPI(
+            latency=options['latency_ms'] / 1000,
+            error_rate=options['error_rate'],
+            flood_rate=options['flood_rate'],
+            retry_after=options['retry_after'],
+            chat_rate=options['chat_rate'],
+            seed=options['seed'],
+        )
+        server = make_server(api, options['host'], options['port'])
+        host, port = server.server_address[:2]
+        self.stdout.write(f"Fake Bot API on http://{host}:{port} (TELEGRAM_API_BASE=http://{host}:{port}), stats at /stats")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(json.dumps(api.stats(), indent=2, sort_keys=True))
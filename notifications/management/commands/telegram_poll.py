@@ -0,0 +1,74 @@
+import logging
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from notifications.updates import consume_updates, get_updates, load_offset
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Long-poll Telegram getUpdates in a loop over a kept-alive connection and process "
+        "/link <code> messages as they arrive. Stops gracefully on SIGTERM/SIGINT."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int, default=25, help='Long-poll timeout of getUpdates, seconds')
+        parser.add_argument('--limit', type=int, default=100, help='Max updates per getUpdates call')
+        parser.add_argument('--max-backoff', type=float, default=30.0, help='Max pause after errors, seconds')
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        self.waiting = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        backoff = 0.0
+        self.stdout.write(f"Polling Telegram updates (timeout={options['timeout']}s)")
+        while not self.stopping:
+            # Drop a broken or expired DB connection before touching the DB, also after errors
+            close_old_connections()
+            try:
+                # Other replicas may have moved the shared offset meanwhile
+                offset = load_offset()
+                # Only the idle long poll may be interrupted, never the processing
+                self.waiting = True
+                try:
+                    updates = get_updates(offset, options['limit'], timeout=max(0, options['timeout']))
+                finally:
+                    self.waiting = False
+            except _Interrupted:
+                break
+            except Exception as e:
+                backoff = min(options['max_backoff'], backoff * 2 or 1.0)
+                logger.warning("getUpdates failed, retrying in %.0fs: %s", backoff, e)
+                self._sleep(backoff)
+                continue
+            backoff = 0.0
+
+            if not updates:
+                continue
+            # The long poll may have outlived the connection
+            close_old_connections()
+            consume_updates(updates, offset)
+
+        self.stdout.write("Telegram polling stopped")
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        if self.waiting:
+            raise _Interrupted()
+
+    def _sleep(self, seconds: float) -> None:
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(0.5, deadline - time.monotonic()))
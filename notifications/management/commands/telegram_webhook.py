@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from notifications import telegram
+
+
+class Command(BaseCommand):
+    help = (
+        "Register the webhook (setWebhook with TELEGRAM_WEBHOOK_SECRET) or remove it with --delete "
+        "to go back to polling."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='?', help='Public URL of /api/telegram/webhook/')
+        parser.add_argument('--delete', action='store_true', help='deleteWebhook')
+        parser.add_argument('--max-connections', type=int, default=40)
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            resp = telegram.call('deleteWebhook')
+        else:
+            secret = getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '')
+            if not options['url'] or not secret:
+                raise CommandError('Pass the webhook URL and set TELEGRAM_WEBHOOK_SECRET')
+            resp = telegram.call('setWebhook', json={
+                'url': options['url'],
+                'secret_token': secret,
+                'allowed_updates': ['message'],
+                'max_connections': options['max_connections'],
+            })
+        if not resp.ok or not resp.json().get('ok'):
+            raise CommandError(f"Telegram refused: {resp.text}")
+        self.stdout.write(self.style.SUCCESS(resp.json().get('description') or 'OK'))
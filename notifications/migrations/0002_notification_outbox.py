@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-18 16:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('habits', '0003_habit_claim_lease'),
+        ('notifications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scheduled_for', models.DateTimeField(verbose_name='Запланировано на')),
+                ('text', models.TextField(verbose_name='Текст')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('sent', 'Отправлено'), ('dead', 'Не доставлено')], default='pending', max_length=16, verbose_name='Статус')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('next_attempt_at', models.DateTimeField(verbose_name='Следующая попытка')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('claimed_by', models.CharField(blank=True, default='', max_length=64, verbose_name='Захвачена воркером')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Отправлено в')),
+                ('habit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='habits.habit', verbose_name='Привычка')),
+            ],
+            options={
+                'verbose_name': 'Исходящее уведомление',
+                'verbose_name_plural': 'Исходящие уведомления',
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='notificatio_status_0a6c2d_idx')],
+                'constraints': [models.UniqueConstraint(fields=('habit', 'scheduled_for'), name='notifications_outbox_unique_occurrence')],
+            },
+        ),
+    ]
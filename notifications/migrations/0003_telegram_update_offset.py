@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-18 17:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0002_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramUpdateOffset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=32, unique=True, verbose_name='Имя')),
+                ('update_id', models.BigIntegerField(blank=True, null=True, verbose_name='Последний update_id')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлён')),
+            ],
+            options={
+                'verbose_name': 'Смещение getUpdates',
+                'verbose_name_plural': 'Смещения getUpdates',
+            },
+        ),
+    ]
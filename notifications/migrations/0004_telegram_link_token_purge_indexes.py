@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0003_telegram_update_offset'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='telegramlinktoken',
+            index=models.Index(fields=['expires_at'], name='tg_link_token_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='telegramlinktoken',
+            index=models.Index(condition=models.Q(('used_at__isnull', False)), fields=['used_at'], name='tg_link_token_used_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.2 on 2026-10-18 17:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_telegram_link_token_purge_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelegramWebhookUpdate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('update_id', models.BigIntegerField(unique=True, verbose_name='update_id')),
+                ('received_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Получено')),
+            ],
+            options={
+                'verbose_name': 'Обновление webhook Telegram',
+                'verbose_name_plural': 'Обновления webhook Telegram',
+            },
+        ),
+    ]
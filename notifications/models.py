@@ -36,8 +36,78 @@ class TelegramLinkToken(models.Model):
     class Meta:
         verbose_name = 'Код привязки Telegram'
         verbose_name_plural = 'Коды привязки Telegram'
-        indexes = [models.Index(fields=['code'])]
+        indexes = [
+            models.Index(fields=['code']),
+            # Очистка просроченных и использованных кодов (purge_telegram_link_tokens)
+            models.Index(fields=['expires_at'], name='tg_link_token_expires_idx'),
+            models.Index(fields=['used_at'], condition=models.Q(used_at__isnull=False), name='tg_link_token_used_idx'),
+        ]
 
     def __str__(self):
         state = 'used' if self.used_at else 'active'
         return f"{self.user} | {self.code} ({state})"
+
+
+class TelegramUpdateOffset(models.Model):
+    """Последний обработанный update_id getUpdates; общий для всех реплик поллера."""
+
+    name = models.CharField(max_length=32, unique=True, verbose_name='Имя')
+    update_id = models.BigIntegerField(null=True, blank=True, verbose_name='Последний update_id')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлён')
+
+    class Meta:
+        verbose_name = 'Смещение getUpdates'
+        verbose_name_plural = 'Смещения getUpdates'
+
+    def __str__(self):
+        return f"{self.name}: {self.update_id}"
+
+
+class TelegramWebhookUpdate(models.Model):
+    """update_id, уже принятый webhook'ом: повторная доставка Telegram не обрабатывается дважды."""
+
+    update_id = models.BigIntegerField(unique=True, verbose_name='update_id')
+    received_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Получено')
+
+    class Meta:
+        verbose_name = 'Обновление webhook Telegram'
+        verbose_name_plural = 'Обновления webhook Telegram'
+
+    def __str__(self):
+        return str(self.update_id)
+
+
+class NotificationOutbox(models.Model):
+    """Очередь исходящих напоминаний: одна запись на (привычка, время запуска)."""
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'В очереди'
+        SENT = 'sent', 'Отправлено'
+        DEAD = 'dead', 'Не доставлено'
+
+    habit = models.ForeignKey(
+        'habits.Habit',
+        on_delete=models.CASCADE,
+        related_name='outbox',
+        verbose_name='Привычка',
+    )
+    scheduled_for = models.DateTimeField(verbose_name='Запланировано на')
+    text = models.TextField(verbose_name='Текст')
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING, verbose_name='Статус')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
+    next_attempt_at = models.DateTimeField(verbose_name='Следующая попытка')
+    last_error = models.TextField(blank=True, verbose_name='Последняя ошибка')
+    claimed_by = models.CharField(max_length=64, blank=True, default='', verbose_name='Захвачена воркером')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создано')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Отправлено в')
+
+    class Meta:
+        verbose_name = 'Исходящее уведомление'
+        verbose_name_plural = 'Исходящие уведомления'
+        constraints = [
+            models.UniqueConstraint(fields=['habit', 'scheduled_for'], name='notifications_outbox_unique_occurrence'),
+        ]
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"{self.habit_id} @ {self.scheduled_for} ({self.status})"
@@ -0,0 +1,119 @@
+"""Token buckets for Telegram Bot API limits (~30 msg/s per bot, ~1 msg/s per chat).
+
+The `redis` backend is shared by all worker processes; `local` only limits the
+current process and is meant for development and tests.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from habits_project.backends import get_backend
+
+logger = logging.getLogger(__name__)
+
+
+# KEYS[1] - bucket key; ARGV - rate (tokens/s), capacity, now (s).
+# Returns how long to wait before a token is available ("0" if one was taken).
+_TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class LocalTokenBuckets:
+    """In-process token buckets."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    def take(self, key: str, rate: float, capacity: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+        return wait
+
+
+class RedisTokenBuckets:
+    """Token buckets kept in Redis and updated atomically by a Lua script."""
+
+    def __init__(self, client):
+        self._client = client
+        self._script = self._client.register_script(_TOKEN_BUCKET_LUA)
+
+    def take(self, key: str, rate: float, capacity: float) -> float:
+        return float(self._script(keys=[f"telegram:rl:{key}"], args=[rate, capacity, time.time()]))
+
+
+def get_buckets():
+    """Return the configured bucket backend, or None when rate limiting is off."""
+    return get_backend('TELEGRAM_RATE_LIMIT_BACKEND', 'TELEGRAM_RATE_LIMIT_REDIS_URL', LocalTokenBuckets, RedisTokenBuckets)
+
+
+def _bucket_specs(chat_id):
+    per_chat = float(getattr(settings, 'TELEGRAM_PER_CHAT_RATE', 1))
+    global_rate = float(getattr(settings, 'TELEGRAM_GLOBAL_RATE', 30))
+    return ((f"chat:{chat_id}", per_chat, 1), ('global', global_rate, global_rate))
+
+
+def _take(buckets, key, rate, capacity) -> float:
+    try:
+        return buckets.take(key, rate, capacity)
+    except Exception as e:
+        # Do not stop sending because the limiter store is unavailable
+        logger.warning("Rate limiter unavailable: %s", e)
+        return 0.0
+
+
+async def acquire_send_slot_async(chat_id, max_wait: float | None = None) -> float:
+    """Wait for a per-chat and a global token before sending to `chat_id`.
+
+    Waits with `asyncio.sleep` while the wait fits into `max_wait`
+    (`TELEGRAM_RATE_LIMIT_MAX_WAIT`). Returns 0 when the message may be sent
+    now, otherwise the number of seconds after which the caller should retry
+    instead. The bucket store is called in the loop's default executor, so a
+    slow Redis round trip doesn't stall the other sends on the event loop.
+    """
+    buckets = get_buckets()
+    if buckets is None:
+        return 0.0
+    if max_wait is None:
+        max_wait = float(getattr(settings, 'TELEGRAM_RATE_LIMIT_MAX_WAIT', 5))
+
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + max_wait
+    for key, rate, capacity in _bucket_specs(chat_id):
+        while True:
+            wait = await loop.run_in_executor(None, _take, buckets, key, rate, capacity)
+            if wait <= 0:
+                break
+            if time.monotonic() + wait > deadline:
+                return wait
+            await asyncio.sleep(wait)
+    return 0.0
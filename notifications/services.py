@@ -1,48 +1,115 @@
+import asyncio
 import logging
-import requests
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+import httpx
 
 from django.conf import settings
 
+from habits_project import metrics
+from . import telegram
 from .models import TelegramProfile
+from .ratelimit import acquire_send_slot_async
 
 logger = logging.getLogger(__name__)
 
 
-API_BASE = "https://api.telegram.org"
-
+@dataclass
+class SendResult:
+    """Outcome of a sendMessage call; truthy when the message was delivered.
 
-def _bot_token() -> str:
-    token = getattr(settings, 'TELEGRAM_BOT_TOKEN', None)
-    if not token:
-        raise RuntimeError('TELEGRAM_BOT_TOKEN is not configured')
-    return token
+    `retry_after` is set when Telegram (HTTP 429) or the local rate limiter
+    asks to try again later: the message should be rescheduled, not dropped.
+    """
+    ok: bool
+    retry_after: Optional[float] = None
+    error: str = ''
 
+    def __bool__(self):
+        return self.ok
 
-def send_telegram_message(user, text: str) -> bool:
-    """Send a Telegram message to a user linked via TelegramProfile.
 
-    Returns True if sent successfully, False otherwise.
-    """
-    try:
-        profile = TelegramProfile.objects.get(user=user)
-    except TelegramProfile.DoesNotExist:
-        logger.warning("User %s has no TelegramProfile; skip sending", user)
-        return False
+async def _post_message(client: httpx.AsyncClient, path: str, chat_id: int, text: str) -> SendResult:
+    wait = await acquire_send_slot_async(chat_id)
+    if wait:
+        metrics.inc('telegram_errors_total', method='sendMessage', reason='rate_limited')
+        return SendResult(ok=False, retry_after=wait, error='Rate limited locally')
 
-    token = _bot_token()
-    url = f"{API_BASE}/bot{token}/sendMessage"
     payload = {
-        'chat_id': profile.chat_id,
+        'chat_id': chat_id,
         'text': text,
         'parse_mode': 'HTML',
         'disable_web_page_preview': True,
     }
     try:
-        resp = requests.post(url, json=payload, timeout=10)
-        ok = resp.ok and resp.json().get('ok') is True
-        if not ok:
-            logger.error("Telegram sendMessage failed: %s", resp.text)
-        return bool(ok)
+        with metrics.timed('telegram_request_seconds', method='sendMessage'):
+            resp = await client.post(path, json=payload)
+        data = resp.json() if resp.content else {}
+        if resp.is_success and data.get('ok') is True:
+            return SendResult(ok=True)
+        retry_after = (data.get('parameters') or {}).get('retry_after')
+        if resp.status_code == 429 and retry_after is not None:
+            metrics.inc('telegram_errors_total', method='sendMessage', reason='flood')
+            logger.warning("Telegram flood limit for chat %s, retry after %ss", chat_id, retry_after)
+            return SendResult(ok=False, retry_after=float(retry_after), error=resp.text)
+        metrics.inc('telegram_errors_total', method='sendMessage', reason='api')
+        logger.error("Telegram sendMessage failed: %s", resp.text)
+        return SendResult(ok=False, error=resp.text)
     except Exception as e:
+        metrics.inc('telegram_errors_total', method='sendMessage', reason='network')
         logger.exception("Failed to send Telegram message: %s", e)
-        return False
+        return SendResult(ok=False, error=str(e))
+
+
+async def _send_batch(client: httpx.AsyncClient, items, path: str, concurrency: int) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send_one(chat_id, text):
+        async with semaphore:
+            return await _post_message(client, path, chat_id, text)
+
+    # One failing send must not discard the results already received for the others
+    results = await asyncio.gather(*(send_one(chat_id, text) for chat_id, text in items), return_exceptions=True)
+    for i, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.error("Failed to send Telegram message: %r", result)
+            results[i] = SendResult(ok=False, error=str(result) or type(result).__name__)
+    return results
+
+
+def send_telegram_messages_batch(items: Iterable[tuple], concurrency: Optional[int] = None) -> list:
+    """Send `(chat_id, text)` pairs concurrently over the shared pooled HTTP client.
+
+    At most `concurrency` (`TELEGRAM_SEND_CONCURRENCY`) requests are in flight;
+    the next one starts as soon as any finishes. Returns a SendResult per item,
+    in the order of `items`; a send that raised gets a failed SendResult.
+    """
+    items = list(items)
+    if not items:
+        return []
+    path = telegram.method_path('sendMessage')
+    if concurrency is None:
+        concurrency = int(getattr(settings, 'TELEGRAM_SEND_CONCURRENCY', 20))
+    return telegram.run_async(lambda client: _send_batch(client, items, path, max(1, concurrency)))
+
+
+def deliver_telegram_message(chat_id: int, text: str) -> SendResult:
+    """Send `text` to `chat_id` respecting the global and per-chat rate limits."""
+    return send_telegram_messages_batch([(chat_id, text)], concurrency=1)[0]
+
+
+def send_telegram_message(user, text: str, chat_id: Optional[int] = None) -> SendResult:
+    """Send a Telegram message to a user linked via TelegramProfile.
+
+    Pass `chat_id` when it is already known to skip the profile lookup.
+    Returns a SendResult, truthy if sent successfully.
+    """
+    if chat_id is None:
+        try:
+            chat_id = TelegramProfile.objects.get(user=user).chat_id
+        except TelegramProfile.DoesNotExist:
+            logger.warning("User %s has no TelegramProfile; skip sending", user)
+            return SendResult(ok=False, error='No TelegramProfile')
+
+    return deliver_telegram_message(chat_id, text)
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from habits_project import metrics
+from .models import NotificationOutbox, TelegramLinkToken, TelegramWebhookUpdate
+from .services import SendResult, send_telegram_messages_batch
+from .updates import claim_webhook_updates, process_updates
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempts: int) -> timedelta:
+    """Exponential backoff after `attempts` failed deliveries, capped at one hour."""
+    base = int(getattr(settings, 'NOTIFICATIONS_OUTBOX_BACKOFF_SECONDS', 30))
+    return timedelta(seconds=min(base * 2 ** max(attempts - 1, 0), 3600))
+
+
+def claim_outbox(worker_id: str, now, limit: int) -> list[NotificationOutbox]:
+    """Lease up to `limit` pending outbox rows whose attempt time has come.
+
+    The lease is the row's `next_attempt_at` pushed forward: if the worker
+    dies, the row becomes visible again once it expires.
+    """
+    lease_until = now + timedelta(seconds=int(getattr(settings, 'NOTIFICATIONS_OUTBOX_LEASE_SECONDS', 120)))
+    ready = NotificationOutbox.objects.filter(
+        status=NotificationOutbox.Status.PENDING,
+        next_attempt_at__lte=now,
+    )
+    ids = list(ready.order_by('next_attempt_at', 'id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    ready.filter(id__in=ids).update(claimed_by=worker_id, next_attempt_at=lease_until)
+    return list(
+        NotificationOutbox.objects
+        .select_related('habit__user__telegram')
+        .filter(claimed_by=worker_id, next_attempt_at=lease_until)
+    )
+
+
+def deliver_outbox_rows(rows, now) -> dict:
+    """Send claimed outbox rows as one concurrent batch and record the outcome of every attempt.
+
+    Chat ids come from the joined `habit.user.telegram`; rows of users
+    without a linked chat fail without a request. Failed rows are retried
+    with exponential backoff and marked dead after
+    `NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS` attempts; rate-limited rows are
+    retried after the requested `retry_after`.
+    """
+    max_attempts = int(getattr(settings, 'NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS', 5))
+    stats = {'sent': 0, 'retry': 0, 'dead': 0}
+    linked = [row for row in rows if getattr(row.habit.user, 'telegram', None) is not None]
+    try:
+        sent = send_telegram_messages_batch([(row.habit.user.telegram.chat_id, row.text) for row in linked])
+        results = {row.id: result for row, result in zip(linked, sent)}
+    except Exception as e:
+        logger.exception("Outbox batch delivery failed: %s", e)
+        results = {row.id: SendResult(ok=False, error=str(e)) for row in linked}
+
+    for row in rows:
+        row.claimed_by = ''
+        result = results.get(row.id, SendResult(ok=False, error='No TelegramProfile'))
+        ok = bool(result)
+        retry_after = getattr(result, 'retry_after', None)
+        error = getattr(result, 'error', '') or ('' if ok else 'Telegram sendMessage failed')
+
+        if retry_after:
+            # Rate limited: not the message's fault, so it doesn't cost an attempt
+            row.next_attempt_at = now + timedelta(seconds=retry_after)
+            row.last_error = error
+            stats['retry'] += 1
+            continue
+
+        row.attempts += 1
+        if ok:
+            row.status = NotificationOutbox.Status.SENT
+            row.sent_at = now
+            row.last_error = ''
+            stats['sent'] += 1
+            metrics.observe('habits_dispatch_lag_seconds', max(0.0, (timezone.now() - row.scheduled_for).total_seconds()))
+        elif row.attempts >= max_attempts:
+            row.status = NotificationOutbox.Status.DEAD
+            row.last_error = error
+            stats['dead'] += 1
+        else:
+            row.next_attempt_at = now + backoff_delay(row.attempts)
+            row.last_error = error
+            stats['retry'] += 1
+
+    for outcome, count in stats.items():
+        metrics.inc('notifications_outbox_deliveries_total', count, outcome=outcome)
+    with transaction.atomic():
+        NotificationOutbox.objects.bulk_update(
+            rows,
+            ['status', 'attempts', 'next_attempt_at', 'last_error', 'claimed_by', 'sent_at'],
+        )
+    return stats
+
+
+@shared_task
+def drain_notification_outbox(max_batches: int = 10) -> dict:
+    """Deliver pending outbox rows in batches of `NOTIFICATIONS_OUTBOX_BATCH_SIZE`.
+
+    Each batch is sent concurrently and written back before the next one is claimed.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    limit = max(1, int(getattr(settings, 'NOTIFICATIONS_OUTBOX_BATCH_SIZE', 100)))
+
+    totals = {'sent': 0, 'retry': 0, 'dead': 0}
+    for _ in range(max_batches):
+        now = timezone.now()
+        rows = claim_outbox(worker_id, now, limit)
+        if not rows:
+            break
+        for key, value in deliver_outbox_rows(rows, now).items():
+            totals[key] += value
+
+    if totals['dead']:
+        logger.warning("Outbox: %s notifications moved to dead letter", totals['dead'])
+    return totals
+
+
+@shared_task
+def process_telegram_updates(updates: list) -> int:
+    """Process updates received by the webhook (`/link <код>`); returns how many were new.
+
+    Updates Telegram delivered again are skipped (see `claim_webhook_updates`).
+    """
+    fresh = claim_webhook_updates(updates)
+    process_updates(fresh)
+    return len(fresh)
+
+
+def _delete_in_chunks(qs, chunk_size: int, max_chunks: int) -> int:
+    deleted = 0
+    for _ in range(max_chunks):
+        ids = list(qs.order_by().values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        # Short statements by primary key: no long lock on the table
+        count, _ = qs.model.objects.filter(id__in=ids).delete()
+        deleted += count
+        if len(ids) < chunk_size:
+            break
+    return deleted
+
+
+@shared_task
+def purge_telegram_link_tokens() -> dict:
+    """Delete expired and used link codes older than `TELEGRAM_LINK_TOKEN_RETENTION_HOURS`.
+
+    Rows go in chunks of `TELEGRAM_LINK_TOKEN_PURGE_CHUNK_SIZE`, at most
+    `TELEGRAM_LINK_TOKEN_PURGE_MAX_CHUNKS` per kind and run; the rest waits
+    for the next run.
+    """
+    cutoff = timezone.now() - timedelta(hours=int(getattr(settings, 'TELEGRAM_LINK_TOKEN_RETENTION_HOURS', 24)))
+    chunk_size = max(1, int(getattr(settings, 'TELEGRAM_LINK_TOKEN_PURGE_CHUNK_SIZE', 1000)))
+    max_chunks = max(1, int(getattr(settings, 'TELEGRAM_LINK_TOKEN_PURGE_MAX_CHUNKS', 100)))
+
+    purged = {
+        'used': _delete_in_chunks(TelegramLinkToken.objects.filter(used_at__lt=cutoff), chunk_size, max_chunks),
+        'expired': _delete_in_chunks(
+            TelegramLinkToken.objects.filter(used_at__isnull=True, expires_at__lt=cutoff), chunk_size, max_chunks,
+        ),
+    }
+    for reason, count in purged.items():
+        metrics.inc('telegram_link_tokens_purged_total', count, reason=reason)
+    if any(purged.values()):
+        logger.info("Purged Telegram link tokens: %s", purged)
+    return purged
+
+
+@shared_task
+def purge_telegram_webhook_updates() -> int:
+    """Forget webhook update_ids older than `TELEGRAM_WEBHOOK_DEDUP_HOURS` (Telegram stops re-delivering by then)."""
+    cutoff = timezone.now() - timedelta(hours=int(getattr(settings, 'TELEGRAM_WEBHOOK_DEDUP_HOURS', 24)))
+    chunk_size = max(1, int(getattr(settings, 'TELEGRAM_LINK_TOKEN_PURGE_CHUNK_SIZE', 1000)))
+    max_chunks = max(1, int(getattr(settings, 'TELEGRAM_LINK_TOKEN_PURGE_MAX_CHUNKS', 100)))
+    return _delete_in_chunks(TelegramWebhookUpdate.objects.filter(received_at__lt=cutoff), chunk_size, max_chunks)
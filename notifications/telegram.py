@@ -0,0 +1,162 @@
+"""Process-wide Telegram Bot API clients.
+
+Both the sync `requests.Session` and the async `httpx.AsyncClient` keep their
+connections alive between calls, so reminders and link replies don't pay for a
+new TCP+TLS handshake each time. Clients are recreated after a fork.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from contextlib import nullcontext
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from habits_project import metrics
+
+
+# Default Bot API endpoint; TELEGRAM_API_BASE overrides it (e.g. the fake_telegram_api server)
+API_BASE = "https://api.telegram.org"
+
+_lock = threading.Lock()
+_pid = None
+_session = None
+_loop = None
+_async_client = None
+
+
+def bot_token() -> str:
+    token = getattr(settings, 'TELEGRAM_BOT_TOKEN', None)
+    if not token:
+        raise RuntimeError('TELEGRAM_BOT_TOKEN is not configured')
+    return token
+
+
+def api_base() -> str:
+    return (getattr(settings, 'TELEGRAM_API_BASE', '') or API_BASE).rstrip('/')
+
+
+def method_path(method: str) -> str:
+    return f"/bot{bot_token()}/{method}"
+
+
+def api_url(method: str) -> str:
+    return f"{api_base()}{method_path(method)}"
+
+
+def timeouts() -> tuple[float, float]:
+    """(connect, read) timeouts in seconds."""
+    return (
+        float(getattr(settings, 'TELEGRAM_CONNECT_TIMEOUT', 5)),
+        float(getattr(settings, 'TELEGRAM_READ_TIMEOUT', 10)),
+    )
+
+
+def _pool_size() -> int:
+    return max(1, int(getattr(settings, 'TELEGRAM_POOL_SIZE', 20)))
+
+
+def build_session() -> requests.Session:
+    # Only connection errors are retried: a POST that reached Telegram must not be repeated
+    retry = Retry(
+        total=int(getattr(settings, 'TELEGRAM_CONNECT_RETRIES', 3)),
+        connect=int(getattr(settings, 'TELEGRAM_CONNECT_RETRIES', 3)),
+        read=0,
+        status=0,
+        backoff_factor=0.3,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_pool_size(), max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def build_async_client() -> httpx.AsyncClient:
+    connect, read = timeouts()
+    size = _pool_size()
+    # httpx ignores the client's `limits` when a transport is given: the pool is sized on the transport
+    transport = httpx.AsyncHTTPTransport(
+        retries=int(getattr(settings, 'TELEGRAM_CONNECT_RETRIES', 3)),
+        limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+    )
+    return httpx.AsyncClient(
+        base_url=api_base(),
+        timeout=httpx.Timeout(read, connect=connect),
+        transport=transport,
+    )
+
+
+def _check_pid() -> None:
+    global _pid, _session, _loop, _async_client
+    if _pid != os.getpid():
+        # Forked (e.g. a Celery prefork worker): the parent's sockets and loop thread are not ours
+        _pid, _session, _loop, _async_client = os.getpid(), None, None, None
+
+
+def get_session() -> requests.Session:
+    """Shared keep-alive session for sync calls."""
+    global _session
+    with _lock:
+        _check_pid()
+        if _session is None:
+            _session = build_session()
+        return _session
+
+
+def _get_async():
+    global _loop, _async_client
+    with _lock:
+        _check_pid()
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='telegram-client', daemon=True).start()
+        if _async_client is None:
+            _async_client = build_async_client()
+        return _loop, _async_client
+
+
+def run_async(make_coro):
+    """Run `make_coro(client)` on the process-wide event loop with the shared AsyncClient.
+
+    Blocks until the coroutine finishes and returns its result.
+    """
+    loop, client = _get_async()
+    return asyncio.run_coroutine_threadsafe(make_coro(client), loop).result()
+
+
+def call(method: str, *, json=None, params=None, timeout=None) -> requests.Response:
+    """Sync Bot API call over the shared session.
+
+    A long-polling `getUpdates` waits for updates rather than for the API, so
+    it is left out of the `telegram_request_seconds` latency histogram.
+    """
+    long_poll = method == 'getUpdates' and bool((json or params or {}).get('timeout'))
+    try:
+        with nullcontext() if long_poll else metrics.timed('telegram_request_seconds', method=method):
+            resp = get_session().post(api_url(method), json=json, params=params, timeout=timeout or timeouts())
+    except requests.RequestException:
+        metrics.inc('telegram_errors_total', method=method, reason='network')
+        raise
+    if not resp.ok:
+        metrics.inc('telegram_errors_total', method=method, reason='flood' if resp.status_code == 429 else 'api')
+    return resp
+
+
+def reset_clients() -> None:
+    """Close the shared clients; they are rebuilt on next use."""
+    global _session, _loop, _async_client
+    with _lock:
+        session, loop, client = _session, _loop, _async_client
+        _session, _loop, _async_client = None, None, None
+    if session is not None:
+        session.close()
+    if loop is not None:
+        if client is not None:
+            asyncio.run_coroutine_threadsafe(client.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,260 @@
+"""Processing of incoming Telegram updates (`/link <код>`), shared by the poll commands."""
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from typing import Iterable, Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import telegram
+from .models import TelegramLinkToken, TelegramProfile, TelegramUpdateOffset, TelegramWebhookUpdate
+
+logger = logging.getLogger(__name__)
+
+
+# Legacy offset file of older versions; only read once to seed the DB row
+OFFSET_FILE = ".telegram_offset"
+OFFSET_NAME = 'getUpdates'
+
+
+class _OffsetConflict(Exception):
+    pass
+
+
+def _base_dir() -> Path:
+    # BASE_DIR from settings
+    return Path(getattr(settings, 'BASE_DIR', Path.cwd()))
+
+
+def _legacy_offset() -> Optional[int]:
+    p = _base_dir() / OFFSET_FILE
+    if not p.exists():
+        return None
+    try:
+        data = json.loads(p.read_text(encoding='utf-8'))
+        return int(data.get('update_id')) if data and 'update_id' in data else None
+    except Exception:
+        return None
+
+
+def load_offset() -> Optional[int]:
+    """update_id of the last processed update, if any."""
+    row = TelegramUpdateOffset.objects.filter(name=OFFSET_NAME).values_list('update_id', flat=True)
+    if row:
+        return row[0]
+    row, _created = TelegramUpdateOffset.objects.get_or_create(
+        name=OFFSET_NAME, defaults={'update_id': _legacy_offset()},
+    )
+    return row.update_id
+
+
+def advance_offset(expected: Optional[int], update_id: int) -> bool:
+    """Move the offset from `expected` to `update_id`; False if another poller moved it first."""
+    qs = TelegramUpdateOffset.objects.filter(name=OFFSET_NAME)
+    qs = qs.filter(update_id__isnull=True) if expected is None else qs.filter(update_id=expected)
+    return qs.update(update_id=update_id) == 1
+
+
+REPLY_NO_CODE = 'Нужно передать код: /link <код>'
+REPLY_NOT_FOUND = 'Код не найден или уже использован. Сгенерируйте новый в личном кабинете.'
+REPLY_EXPIRED = 'Код истёк. Сгенерируйте новый в личном кабинете.'
+REPLY_LINKED = '✅ Telegram успешно привязан к вашему аккаунту. Теперь вы будете получать уведомления.'
+
+
+def send_replies(replies: list[tuple]) -> None:
+    """Send `(chat_id, text)` replies concurrently once the current transaction commits.
+
+    A rolled back chunk is processed again, and the user must not get the reply twice.
+    """
+    if replies:
+        transaction.on_commit(lambda: _send_replies_now(replies))
+
+
+def _send_replies_now(replies: list[tuple]) -> None:
+    # Late import: services pulls in the async client only when it is needed
+    from .services import send_telegram_messages_batch
+
+    try:
+        for (chat_id, _text), result in zip(replies, send_telegram_messages_batch(replies)):
+            if not result:
+                logger.warning("Failed to send reply to %s: %s", chat_id, getattr(result, 'error', ''))
+    except Exception as e:
+        logger.warning("Failed to send replies: %s", e)
+
+
+def get_updates(offset: Optional[int], limit: int, timeout: int = 0) -> list[dict]:
+    """Call getUpdates; `timeout` > 0 long-polls until an update arrives or it elapses.
+
+    Raises on HTTP and API errors.
+    """
+    params = {'timeout': timeout, 'limit': limit}
+    if offset is not None:
+        params['offset'] = offset + 1
+    connect_timeout, read_timeout = telegram.timeouts()
+    # The response may take the whole poll timeout
+    resp = telegram.call('getUpdates', json=params, timeout=(connect_timeout, timeout + read_timeout))
+    resp.raise_for_status()
+    data = resp.json()
+    if not data.get('ok'):
+        raise RuntimeError(f"getUpdates failed: {resp.text}")
+    return data.get('result', [])
+
+
+def parse_link(upd: dict) -> Optional[tuple]:
+    """`(chat_id, username, code)` of a `/link` message (`code` is '' when missing), else None."""
+    msg = upd.get('message') or {}
+    if not msg:
+        return None
+
+    chat = msg.get('chat') or {}
+    chat_id = chat.get('id')
+    from_user = msg.get('from') or {}
+    username = from_user.get('username') or ''
+    text = (msg.get('text') or '').strip()
+
+    if chat_id is None or not text.startswith('/link'):
+        return None
+
+    parts = text.split(maxsplit=1)
+    return chat_id, username, parts[1].strip() if len(parts) > 1 else ''
+
+
+def link_chats(links: list[tuple]) -> list[tuple]:
+    """Apply `(chat_id, username, code)` link requests in bulk; returns the replies to send.
+
+    All codes are resolved with one query; profiles are upserted and tokens
+    consumed with one statement each. A code is consumed once even if it
+    comes twice in the batch. A chat linked to another account moves to the
+    new one.
+    """
+    now = timezone.now()
+    codes = {code for _chat_id, _username, code in links if code}
+    tokens = {
+        t.code: t
+        for t in TelegramLinkToken.objects.filter(code__in=codes, used_at__isnull=True).only('id', 'code', 'user_id', 'expires_at')
+    }
+
+    replies, used, profiles = [], [], {}
+    for chat_id, username, code in links:
+        if not code:
+            replies.append((chat_id, REPLY_NO_CODE))
+            continue
+        token = tokens.pop(code, None)
+        if token is None:
+            replies.append((chat_id, REPLY_NOT_FOUND))
+            continue
+        if token.expires_at <= now:
+            replies.append((chat_id, REPLY_EXPIRED))
+            continue
+        used.append(token.id)
+        # One chat per user and one user per chat: the latest request wins
+        profiles = {uid: p for uid, p in profiles.items() if p.chat_id != chat_id}
+        profiles[token.user_id] = TelegramProfile(user_id=token.user_id, chat_id=chat_id, username=username)
+        replies.append((chat_id, REPLY_LINKED))
+
+    if profiles:
+        chat_ids = [p.chat_id for p in profiles.values()]
+        TelegramProfile.objects.filter(chat_id__in=chat_ids).exclude(user_id__in=list(profiles)).delete()
+        TelegramProfile.objects.bulk_create(
+            list(profiles.values()),
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['chat_id', 'username'],
+        )
+    if used:
+        TelegramLinkToken.objects.filter(id__in=used).update(used_at=now)
+    return replies
+
+
+def process_update(upd: dict) -> None:
+    link = parse_link(upd)
+    if link is not None:
+        send_replies(link_chats([link]))
+
+
+def _process_chunk(chunk: list[dict]) -> None:
+    links = [link for link in map(parse_link, chunk) if link is not None]
+    if not links:
+        return
+    try:
+        with transaction.atomic():
+            send_replies(link_chats(links))
+        return
+    except Exception as e:
+        logger.warning("Batch /link processing failed, retrying the updates one by one: %s", e)
+    for upd in chunk:
+        try:
+            with transaction.atomic():
+                process_update(upd)
+        except Exception as e:
+            # Don't get stuck re-reading an update that can't be processed
+            logger.exception("Failed to process update %s: %s", upd.get('update_id'), e)
+
+
+def _chunk_size(chunk_size: Optional[int] = None) -> int:
+    if chunk_size is None:
+        chunk_size = int(getattr(settings, 'TELEGRAM_UPDATES_CHUNK_SIZE', 20))
+    return max(1, chunk_size)
+
+
+def process_updates(updates: Iterable[dict], chunk_size: Optional[int] = None) -> None:
+    """Process `updates` in update_id order, without touching the offset (webhook)."""
+    updates = sorted(updates, key=lambda u: u.get('update_id', 0))
+    size = _chunk_size(chunk_size)
+    for i in range(0, len(updates), size):
+        _process_chunk(updates[i:i + size])
+
+
+def claim_webhook_updates(updates: Iterable[dict]) -> list[dict]:
+    """Record the update_ids of webhook `updates` and return those not seen before.
+
+    Telegram delivers an update again when our 200 is slow or lost; without
+    this a repeated `/link` would find its code used and contradict the reply
+    already sent. The unique insert also settles two deliveries racing in
+    parallel workers: only one of them gets the update.
+    """
+    fresh, seen = [], set()
+    for upd in updates:
+        update_id = upd.get('update_id')
+        if update_id is None or update_id in seen:
+            continue
+        seen.add(update_id)
+        try:
+            with transaction.atomic():
+                TelegramWebhookUpdate.objects.create(update_id=update_id)
+        except IntegrityError:
+            logger.info("Skipping update %s delivered again by Telegram", update_id)
+            continue
+        fresh.append(upd)
+    return fresh
+
+
+def consume_updates(updates: Iterable[dict], offset: Optional[int], chunk_size: Optional[int] = None) -> Optional[int]:
+    """Process a getUpdates batch and advance the shared offset chunk by chunk.
+
+    Each chunk and its offset move are committed together, so a crash replays
+    at most the chunk in flight. The offset is moved with a compare-and-set:
+    if another poller replica got there first, the chunk is rolled back and
+    processing stops. Returns the offset to continue from.
+    """
+    size = _chunk_size(chunk_size)
+    pending = sorted(
+        (u for u in updates if u.get('update_id') is not None and (offset is None or u['update_id'] > offset)),
+        key=lambda u: u['update_id'],
+    )
+    for i in range(0, len(pending), size):
+        chunk = pending[i:i + size]
+        try:
+            with transaction.atomic():
+                _process_chunk(chunk)
+                if not advance_offset(offset, chunk[-1]['update_id']):
+                    raise _OffsetConflict()
+        except _OffsetConflict:
+            logger.info("getUpdates offset was advanced by another poller, skipping the rest of the batch")
+            return load_offset()
+        offset = chunk[-1]['update_id']
+    return offset
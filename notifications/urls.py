@@ -1,10 +1,11 @@
 from django.urls import path
 
-from .views import GenerateTelegramLinkView
+from .views import GenerateTelegramLinkView, TelegramWebhookView
 
 
 app_name = 'notifications'
 
 urlpatterns = [
     path('telegram/link/', GenerateTelegramLinkView.as_view(), name='telegram-link'),
+    path('telegram/webhook/', TelegramWebhookView.as_view(), name='telegram-webhook'),
 ]
@@ -1,12 +1,20 @@
 from datetime import timedelta
+import hmac
+import logging
 import secrets
 
+from django.conf import settings
 from django.utils import timezone
-from rest_framework.permissions import IsAuthenticated
+from drf_spectacular.utils import extend_schema
+from rest_framework import status
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from .models import TelegramLinkToken
+from .tasks import process_telegram_updates
+
+logger = logging.getLogger(__name__)
 
 
 class GenerateTelegramLinkView(APIView):
@@ -36,3 +44,33 @@ class GenerateTelegramLinkView(APIView):
             'expires_at': token.expires_at,
             'tme_link': tme_link,
         })
+
+
+@extend_schema(exclude=True)
+class TelegramWebhookView(APIView):
+    """Receive updates pushed by Telegram (setWebhook) and process them in Celery.
+
+    Telegram signs every request with the `secret_token` given to setWebhook in
+    the `X-Telegram-Bot-Api-Secret-Token` header. The view only checks it and
+    enqueues the updates, so Telegram gets its 200 at once; a non-2xx answer
+    makes Telegram deliver the update again later.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        secret = getattr(settings, 'TELEGRAM_WEBHOOK_SECRET', '')
+        given = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secret or not hmac.compare_digest(given.encode(), secret.encode()):
+            return Response(status=status.HTTP_403_FORBIDDEN)
+
+        # One update per request from Telegram; a list is accepted for batches
+        updates = request.data if isinstance(request.data, list) else [request.data]
+        updates = [u for u in updates if isinstance(u, dict) and 'update_id' in u]
+        if updates:
+            try:
+                process_telegram_updates.delay(updates)
+            except Exception as e:
+                logger.error("Could not enqueue Telegram updates: %s", e)
+                return Response(status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response({'ok': True})
@@ -1,7 +1,20 @@
+from datetime import datetime
+
 import pytest
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from rest_framework.test import APIClient
 
+from habits_project import backends
+
+
+@pytest.fixture(autouse=True)
+def fresh_backends():
+    # Leases, metrics and rate limit buckets start empty in every test
+    backends.reset()
+    yield
+    backends.reset()
+
 
 @pytest.fixture
 def user(db):
@@ -22,3 +35,21 @@ def auth_client(api_client, user):
     token = resp.data['access']
     api_client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
     return api_client
+
+
+@pytest.fixture
+def fixed_now(monkeypatch):
+    """Freeze `timezone.now()` at 2025-01-01 08:00."""
+    now = timezone.make_aware(datetime(2025, 1, 1, 8, 0, 0), timezone.get_current_timezone())
+    monkeypatch.setattr(timezone, 'now', lambda: now)
+    return now
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Stub the scheduler's Telegram sender: every message succeeds and is recorded here."""
+    messages = []
+    monkeypatch.setattr(
+        'habits.tasks.send_telegram_messages_batch', lambda items: messages.extend(items) or [True] * len(items),
+    )
+    return messages
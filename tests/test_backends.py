@@ -0,0 +1,32 @@
+from habits_project import backends
+
+
+class Local:
+    pass
+
+
+class Remote:
+    def __init__(self, client):
+        self.client = client
+
+
+def test_backend_is_built_once_and_can_be_switched_off(settings):
+    settings.EXAMPLE_BACKEND = 'local'
+    backend = backends.get_backend('EXAMPLE_BACKEND', 'EXAMPLE_REDIS_URL', Local, Remote)
+    assert isinstance(backend, Local)
+    assert backends.get_backend('EXAMPLE_BACKEND', 'EXAMPLE_REDIS_URL', Local, Remote) is backend
+
+    settings.EXAMPLE_BACKEND = ''
+    assert backends.get_backend('EXAMPLE_BACKEND', 'EXAMPLE_REDIS_URL', Local, Remote) is None
+
+
+def test_redis_backends_share_one_client_per_url(settings):
+    settings.FIRST_BACKEND = settings.SECOND_BACKEND = 'redis'
+    settings.FIRST_REDIS_URL = settings.SECOND_REDIS_URL = 'redis://localhost:6379/0'
+    first = backends.get_backend('FIRST_BACKEND', 'FIRST_REDIS_URL', Local, Remote)
+    second = backends.get_backend('SECOND_BACKEND', 'SECOND_REDIS_URL', Local, Remote)
+
+    # No connection is made until a command is sent
+    assert first is not second
+    assert first.client is second.client
+    assert backends.redis_client('redis://localhost:6379/1') is not first.client
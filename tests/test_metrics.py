@@ -0,0 +1,85 @@
+from datetime import time, timedelta
+from io import StringIO
+from types import SimpleNamespace
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from habits.models import Habit
+from habits.tasks import check_and_notify_due_habits
+from habits_project import metrics
+from notifications import telegram
+from notifications.models import TelegramProfile
+
+
+def _value(values, name, **labels):
+    return values.get(metrics._series(name, labels), 0)
+
+
+@pytest.mark.django_db
+def test_tick_records_lag_rows_and_phases(monkeypatch, user):
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', lambda items: [True] * len(items))
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for minutes in (2, 30):
+        Habit.objects.create(
+            user=user, place='Дом', time=time(8, 0), action='Зарядка',
+            periodicity_days=1, reward='', duration_seconds=60,
+            next_run_at=timezone.now() - timedelta(minutes=minutes),
+        )
+    before = metrics.snapshot()
+
+    check_and_notify_due_habits()
+
+    after = metrics.snapshot()
+
+    def delta(name, **labels):
+        return _value(after, name, **labels) - _value(before, name, **labels)
+
+    assert delta('habits_scheduler_rows_scanned_total') == 2
+    assert delta('habits_scheduler_rows_dispatched_total') == 2
+    assert delta('habits_scheduler_ticks_total', outcome='run') == 1
+    assert delta('habits_dispatch_lag_seconds_count') == 2
+    # 2 and 30 minutes late
+    assert delta('habits_dispatch_lag_seconds_bucket', le=60) == 0
+    assert delta('habits_dispatch_lag_seconds_bucket', le=300) == 1
+    assert delta('habits_dispatch_lag_seconds_bucket', le=3600) == 2
+    for phase in ('tick', 'query', 'send', 'writeback'):
+        assert delta('habits_scheduler_phase_seconds_count', phase=phase) >= 1
+
+    out = StringIO()
+    call_command('scheduler_metrics', stdout=out)
+    text = out.getvalue()
+    assert '# TYPE habits_dispatch_lag_seconds histogram' in text
+    assert 'habits_dispatch_lag_seconds_bucket{le="+Inf"}' in text
+    buckets = [line for line in text.splitlines() if line.startswith('habits_dispatch_lag_seconds_bucket')]
+    assert buckets[-1].startswith('habits_dispatch_lag_seconds_bucket{le="+Inf"}')
+
+
+@pytest.mark.django_db
+def test_metrics_endpoint_requires_token(client, settings):
+    settings.METRICS_TOKEN = 'scrape-secret'
+    assert client.get('/metrics/').status_code == 403
+    resp = client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+    assert resp.status_code == 200
+    assert resp['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert b'# TYPE telegram_errors_total counter' in resp.content
+
+
+def test_long_poll_get_updates_is_not_a_latency_sample(monkeypatch, settings):
+    settings.TELEGRAM_BOT_TOKEN = 'test'
+    monkeypatch.setattr(telegram, 'get_session', lambda: SimpleNamespace(post=lambda *a, **kw: SimpleNamespace(ok=True)))
+    before = metrics.snapshot()
+
+    telegram.call('getUpdates', json={'timeout': 25, 'limit': 100})
+    telegram.call('getUpdates', json={'timeout': 0, 'limit': 100})
+    telegram.call('sendMessage', json={'chat_id': 1, 'text': 'x'})
+
+    after = metrics.snapshot()
+
+    def delta(**labels):
+        name = 'telegram_request_seconds_count'
+        return _value(after, name, **labels) - _value(before, name, **labels)
+
+    assert delta(method='getUpdates') == 1
+    assert delta(method='sendMessage') == 1
@@ -0,0 +1,393 @@
+import asyncio
+import json
+import os
+import signal
+import threading
+import time as time_module
+from datetime import time, timedelta
+
+import httpx
+import pytest
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.utils import timezone
+
+from habits.models import Habit
+from habits.tasks import check_and_notify_due_habits
+from habits_project import metrics
+from notifications import telegram
+from notifications import updates as updates_mod
+from notifications.fake_api import FakeBotAPI, make_server
+from notifications.management.commands import telegram_poll
+from notifications.models import TelegramLinkToken, TelegramProfile, TelegramWebhookUpdate
+from notifications.ratelimit import LocalTokenBuckets, acquire_send_slot_async
+from notifications.services import SendResult, deliver_telegram_message, send_telegram_messages_batch
+from notifications.tasks import process_telegram_updates, purge_telegram_link_tokens, purge_telegram_webhook_updates
+from notifications.updates import consume_updates, load_offset
+
+
+@pytest.fixture(autouse=True)
+def fresh_telegram_clients():
+    telegram.reset_clients()
+    yield
+    telegram.reset_clients()
+
+
+def mock_telegram(monkeypatch, handler):
+    """Route the async Telegram client through `handler(request) -> httpx.Response`."""
+    def build():
+        return httpx.AsyncClient(base_url=telegram.API_BASE, transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(telegram, 'build_async_client', build)
+
+
+def test_local_token_bucket_limits_burst():
+    buckets = LocalTokenBuckets()
+    assert buckets.take('chat:1', rate=1, capacity=1) == 0
+    wait = buckets.take('chat:1', rate=1, capacity=1)
+    assert 0 < wait <= 1
+    # Other chats have their own bucket
+    assert buckets.take('chat:2', rate=1, capacity=1) == 0
+
+
+def test_rate_limiter_store_is_not_called_on_the_event_loop(monkeypatch):
+    take_threads = set()
+
+    class SlowBuckets:
+        def take(self, key, rate, capacity):
+            take_threads.add(threading.get_ident())
+            time_module.sleep(0.05)  # a Redis round trip
+            return 0.0
+
+    monkeypatch.setattr('notifications.ratelimit.get_buckets', lambda: SlowBuckets())
+
+    async def acquire_all():
+        return await asyncio.gather(*(acquire_send_slot_async(chat_id) for chat_id in range(4)))
+
+    started = time_module.monotonic()
+    assert asyncio.run(acquire_all()) == [0.0] * 4
+    # 8 blocking takes (per-chat + global) overlap instead of running one by one
+    assert time_module.monotonic() - started < 0.3
+    assert threading.get_ident() not in take_threads
+
+
+def test_deliver_returns_retry_after_on_429(monkeypatch, settings):
+    settings.TELEGRAM_BOT_TOKEN = 'test-token'
+    settings.TELEGRAM_RATE_LIMIT_BACKEND = ''
+    mock_telegram(monkeypatch, lambda request: httpx.Response(429, json={
+        'ok': False, 'error_code': 429, 'parameters': {'retry_after': 7},
+    }))
+
+    result = deliver_telegram_message(42, 'hi')
+    assert not result
+    assert result.retry_after == 7
+
+
+@pytest.mark.django_db
+def test_flood_limited_habit_is_rescheduled_not_dropped(monkeypatch, user, fixed_now):
+    monkeypatch.setattr(
+        'habits.tasks.send_telegram_messages_batch',
+        lambda items: [SendResult(ok=False, retry_after=15) for _ in items],
+    )
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    h = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Вода',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+
+    check_and_notify_due_habits()
+
+    h.refresh_from_db()
+    assert h.next_run_at == fixed_now + timedelta(seconds=15)
+    assert h.last_notified_at is None
+
+
+def test_batch_sender_runs_concurrently_and_keeps_order(monkeypatch, settings):
+    settings.TELEGRAM_BOT_TOKEN = 'test-token'
+    settings.TELEGRAM_RATE_LIMIT_BACKEND = ''
+    in_flight = {'now': 0, 'max': 0}
+
+    async def handler(request):
+        in_flight['now'] += 1
+        in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        await asyncio.sleep(0.01)
+        in_flight['now'] -= 1
+        chat_id = json.loads(request.content)['chat_id']
+        if chat_id == 3:
+            return httpx.Response(400, json={'ok': False, 'description': 'chat not found'})
+        return httpx.Response(200, json={'ok': True, 'result': {}})
+
+    mock_telegram(monkeypatch, handler)
+
+    results = send_telegram_messages_batch([(i, f'msg {i}') for i in range(8)], concurrency=4)
+
+    assert [bool(r) for r in results] == [i != 3 for i in range(8)]
+    assert 1 < in_flight['max'] <= 4
+
+
+def test_batch_sender_keeps_other_results_when_one_send_raises(monkeypatch, settings):
+    settings.TELEGRAM_BOT_TOKEN = 'test-token'
+    settings.TELEGRAM_RATE_LIMIT_BACKEND = ''
+    mock_telegram(monkeypatch, lambda request: httpx.Response(200, json={'ok': True, 'result': {}}))
+
+    async def acquire(chat_id):
+        if chat_id == 2:
+            raise RuntimeError('limiter bug')
+        return 0.0
+
+    monkeypatch.setattr('notifications.services.acquire_send_slot_async', acquire)
+
+    results = send_telegram_messages_batch([(i, f'msg {i}') for i in range(4)], concurrency=2)
+
+    assert [bool(r) for r in results] == [True, True, False, True]
+    assert results[2].error == 'limiter bug'
+
+
+def test_async_client_pool_is_sized_by_setting(settings):
+    settings.TELEGRAM_POOL_SIZE = 7
+    client = telegram.build_async_client()
+    pool = client._transport._pool
+
+    assert pool._max_connections == 7
+    assert pool._max_keepalive_connections == 7
+    asyncio.run(client.aclose())
+
+
+def test_shared_clients_are_reused(monkeypatch, settings):
+    settings.TELEGRAM_BOT_TOKEN = 'test-token'
+    settings.TELEGRAM_RATE_LIMIT_BACKEND = ''
+    clients = []
+
+    def build():
+        client = httpx.AsyncClient(
+            base_url=telegram.API_BASE,
+            transport=httpx.MockTransport(lambda request: httpx.Response(200, json={'ok': True})),
+        )
+        clients.append(client)
+        return client
+
+    monkeypatch.setattr(telegram, 'build_async_client', build)
+
+    assert deliver_telegram_message(1, 'a')
+    assert deliver_telegram_message(2, 'b')
+    assert len(clients) == 1
+    assert telegram.get_session() is telegram.get_session()
+
+
+@pytest.fixture
+def fake_api(settings):
+    api = FakeBotAPI(seed=1)
+    server = make_server(api, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    settings.TELEGRAM_API_BASE = f"http://{host}:{port}/"
+    settings.TELEGRAM_BOT_TOKEN = 'test-token'
+    settings.TELEGRAM_RATE_LIMIT_BACKEND = ''
+    yield api
+    server.shutdown()
+    server.server_close()
+
+
+def test_fake_api_server_end_to_end(fake_api):
+    assert deliver_telegram_message(42, 'hi')
+
+    fake_api.flood_rate, fake_api.retry_after = 1.0, 3
+    result = deliver_telegram_message(42, 'hi')
+    assert not result and result.retry_after == 3
+
+    fake_api.flood_rate, fake_api.chat_rate = 0.0, 1.0
+    assert deliver_telegram_message(7, 'first')
+    assert deliver_telegram_message(7, 'second').retry_after == 1
+
+    fake_api.push_update(99, '/link ABC')
+    updates = telegram.call('getUpdates', json={'timeout': 0}).json()['result']
+    assert [u['message']['text'] for u in updates] == ['/link ABC']
+    assert telegram.call('getUpdates', json={'offset': updates[-1]['update_id'] + 1}).json()['result'] == []
+
+    stats = fake_api.stats()
+    assert stats['sent'] == 2
+    assert stats['flood'] == 2
+    assert stats['method:getUpdates'] == 2
+
+
+@pytest.mark.django_db
+def test_telegram_poll_daemon_links_and_stops_on_sigterm(fake_api, monkeypatch, user, django_capture_on_commit_callbacks):
+    TelegramLinkToken.objects.create(user=user, code='abc123', expires_at=timezone.now() + timedelta(minutes=10))
+    fake_api.push_update(555, '/link abc123')
+
+    def process_then_terminate(updates, offset):
+        result = consume_updates(updates, offset)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return result
+
+    monkeypatch.setattr(telegram_poll, 'consume_updates', process_then_terminate)
+    handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+    try:
+        # Replies go out when the chunk commits
+        with django_capture_on_commit_callbacks(execute=True):
+            call_command('telegram_poll', '--timeout', '1')
+    finally:
+        signal.signal(signal.SIGTERM, handlers[0])
+        signal.signal(signal.SIGINT, handlers[1])
+
+    assert TelegramProfile.objects.get(user=user).chat_id == 555
+    assert load_offset() == 1
+    assert fake_api.stats()['sent'] == 1
+
+
+@pytest.mark.django_db
+def test_telegram_poll_daemon_reconnects_after_db_errors(monkeypatch):
+    events = []
+
+    def failing_load_offset():
+        events.append('load')
+        if events.count('load') == 3:
+            raise KeyboardInterrupt
+        raise RuntimeError('server closed the connection unexpectedly')
+
+    monkeypatch.setattr(telegram_poll, 'close_old_connections', lambda: events.append('close'))
+    monkeypatch.setattr(telegram_poll, 'load_offset', failing_load_offset)
+    monkeypatch.setattr(telegram_poll.Command, '_sleep', lambda self, seconds: None)
+
+    handlers = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            call_command('telegram_poll', '--timeout', '1')
+    finally:
+        signal.signal(signal.SIGTERM, handlers[0])
+        signal.signal(signal.SIGINT, handlers[1])
+
+    # Every iteration, including the ones after an error, drops a broken connection first
+    assert events == ['close', 'load', 'close', 'load', 'close', 'load']
+
+
+@pytest.mark.django_db
+def test_webhook_checks_secret_and_hands_updates_to_celery(
+    api_client, monkeypatch, settings, user, django_capture_on_commit_callbacks,
+):
+    settings.TELEGRAM_WEBHOOK_SECRET = 'hook-secret'
+    replies = []
+    monkeypatch.setattr('notifications.updates._send_replies_now', lambda items: replies.extend(c for c, _ in items))
+    queued = []
+    monkeypatch.setattr(process_telegram_updates, 'delay', queued.append)
+    TelegramLinkToken.objects.create(user=user, code='hook123', expires_at=timezone.now() + timedelta(minutes=10))
+    update = {'update_id': 10, 'message': {'chat': {'id': 777}, 'from': {'username': 'u1'}, 'text': '/link hook123'}}
+
+    url = '/api/telegram/webhook/'
+    assert api_client.post(url, update, format='json').status_code == 403
+    assert api_client.post(url, update, format='json', HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN='wrong').status_code == 403
+    assert queued == []
+
+    resp = api_client.post(url, update, format='json', HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN='hook-secret')
+    assert resp.status_code == 200
+    # Nothing is processed inside the request
+    assert not TelegramProfile.objects.filter(user=user).exists()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        assert process_telegram_updates(*queued) == 1
+    assert TelegramProfile.objects.get(user=user).chat_id == 777
+    assert replies == [777]
+
+    # Telegram re-delivers when our 200 was lost: no second "code already used" reply
+    resp = api_client.post(url, update, format='json', HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN='hook-secret')
+    assert resp.status_code == 200
+    with django_capture_on_commit_callbacks(execute=True):
+        assert process_telegram_updates(queued[-1]) == 0
+    assert replies == [777]
+
+
+@pytest.mark.django_db
+def test_update_offset_advances_per_chunk_and_yields_to_other_pollers(monkeypatch, user):
+    monkeypatch.setattr(updates_mod, '_send_replies_now', lambda items: None)
+    for n in range(3):
+        TelegramLinkToken.objects.create(user=user, code=f'c{n}', expires_at=timezone.now() + timedelta(minutes=10))
+
+    def link(update_id, code):
+        return {'update_id': update_id, 'message': {'chat': {'id': 900 + update_id}, 'text': f'/link {code}'}}
+
+    assert updates_mod.load_offset() is None
+    assert updates_mod.consume_updates([link(1, 'c0'), link(2, 'c1')], None, chunk_size=1) == 2
+    assert updates_mod.load_offset() == 2
+
+    # Another replica already took update 3: this poller's chunk is rolled back
+    assert updates_mod.advance_offset(2, 3)
+    assert updates_mod.consume_updates([link(3, 'c2')], 2) == 3
+    assert not TelegramLinkToken.objects.get(code='c2').used_at
+    assert TelegramProfile.objects.get(user=user).chat_id == 902
+
+
+@pytest.mark.django_db
+def test_link_batch_is_resolved_with_a_few_queries(monkeypatch, django_assert_num_queries, django_capture_on_commit_callbacks):
+    sent = []
+    monkeypatch.setattr(updates_mod, '_send_replies_now', sent.extend)
+    now = timezone.now()
+    users = [get_user_model().objects.create_user(username=f'link{n}', password='pass12345') for n in range(60)]
+    for n, u in enumerate(users):
+        TelegramLinkToken.objects.create(
+            user=u, code=f'code{n}',
+            expires_at=now + (timedelta(minutes=10) if n < 50 else -timedelta(minutes=1)),
+        )
+    # An existing profile of another account on one of the chats is moved over
+    TelegramProfile.objects.create(user=users[59], chat_id=5000)
+
+    batch = [
+        {'update_id': n, 'message': {'chat': {'id': 5000 + n}, 'text': f'/link code{n}'}}
+        for n in range(60)
+    ] + [
+        {'update_id': 60, 'message': {'chat': {'id': 6000}, 'text': '/link code0'}},
+        {'update_id': 61, 'message': {'chat': {'id': 6001}, 'text': '/link'}},
+        {'update_id': 62, 'message': {'chat': {'id': 6002}, 'text': 'hello'}},
+    ]
+
+    # tokens, savepoint, moved profiles, upsert, consumed tokens, release savepoint
+    with django_capture_on_commit_callbacks(execute=True), django_assert_num_queries(6):
+        updates_mod.process_updates(batch, chunk_size=100)
+
+    replies = dict(sent)
+    assert len(sent) == 62
+    assert replies[5000] == replies[5049] == updates_mod.REPLY_LINKED
+    assert replies[5050] == updates_mod.REPLY_EXPIRED
+    assert replies[6000] == updates_mod.REPLY_NOT_FOUND
+    assert replies[6001] == updates_mod.REPLY_NO_CODE
+    assert TelegramProfile.objects.count() == 50
+    assert TelegramProfile.objects.get(chat_id=5000).user == users[0]
+    assert TelegramLinkToken.objects.filter(used_at__isnull=False).count() == 50
+
+
+@pytest.mark.django_db
+def test_purge_link_tokens_deletes_old_codes_in_chunks(settings, user, django_assert_num_queries):
+    settings.TELEGRAM_LINK_TOKEN_RETENTION_HOURS = 24
+    settings.TELEGRAM_LINK_TOKEN_PURGE_CHUNK_SIZE = 2
+    settings.TELEGRAM_LINK_TOKEN_PURGE_MAX_CHUNKS = 10
+    now = timezone.now()
+    old, recent = now - timedelta(days=2), now - timedelta(hours=1)
+    rows = (
+        [dict(expires_at=old)] * 5
+        + [dict(expires_at=old, used_at=old)] * 3
+        # Kept: inside the retention window, or still valid
+        + [dict(expires_at=recent), dict(expires_at=now + timedelta(minutes=10), used_at=recent)]
+        + [dict(expires_at=now + timedelta(minutes=10))]
+    )
+    for n, fields in enumerate(rows):
+        TelegramLinkToken.objects.create(user=user, code=f'gc{n}', **fields)
+    purged = metrics._series('telegram_link_tokens_purged_total', {'reason': 'expired'})
+    before = metrics.snapshot().get(purged, 0)
+
+    # used: 2 chunks (select + delete each); expired: 3 chunks
+    with django_assert_num_queries(10):
+        result = purge_telegram_link_tokens()
+
+    assert result == {'used': 3, 'expired': 5}
+    assert TelegramLinkToken.objects.count() == 3
+    assert metrics.snapshot()[purged] - before == 5
+
+
+@pytest.mark.django_db
+def test_purge_webhook_updates_keeps_recent_ids(settings):
+    settings.TELEGRAM_WEBHOOK_DEDUP_HOURS = 24
+    for update_id in range(3):
+        TelegramWebhookUpdate.objects.create(update_id=update_id)
+    TelegramWebhookUpdate.objects.filter(update_id__lt=2).update(received_at=timezone.now() - timedelta(days=2))
+
+    assert purge_telegram_webhook_updates() == 2
+    assert list(TelegramWebhookUpdate.objects.values_list('update_id', flat=True)) == [2]
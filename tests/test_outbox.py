@@ -0,0 +1,103 @@
+from datetime import time, timedelta
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from habits.models import Habit
+from habits.tasks import check_and_notify_due_habits
+from notifications.models import NotificationOutbox, TelegramProfile
+from notifications.tasks import drain_notification_outbox
+
+
+@pytest.mark.django_db
+def test_due_habits_are_enqueued_once(monkeypatch, settings, user, fixed_now):
+    settings.NOTIFICATIONS_USE_OUTBOX = True
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', lambda *a: pytest.fail('sent inline'))
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    h = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Вода',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+
+    check_and_notify_due_habits()
+    # Same occurrence enqueued again (e.g. overlapping tick) is ignored by the unique constraint
+    Habit.objects.filter(id=h.id).update(next_run_at=fixed_now, last_notified_at=None)
+    check_and_notify_due_habits()
+
+    row = NotificationOutbox.objects.get()
+    assert row.habit_id == h.id
+    assert row.scheduled_for == fixed_now
+    assert row.status == NotificationOutbox.Status.PENDING
+    assert 'Вода' in row.text
+    h.refresh_from_db()
+    assert h.next_run_at == fixed_now + timedelta(days=1)
+
+
+@pytest.mark.django_db
+def test_drain_retries_with_backoff_then_dead_letters(monkeypatch, settings, user, fixed_now):
+    settings.NOTIFICATIONS_OUTBOX_MAX_ATTEMPTS = 2
+    settings.NOTIFICATIONS_OUTBOX_BACKOFF_SECONDS = 30
+    h = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Вода',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    row = NotificationOutbox.objects.create(habit=h, scheduled_for=fixed_now, text='hi', next_attempt_at=fixed_now)
+    monkeypatch.setattr('notifications.tasks.send_telegram_messages_batch', lambda items: [False] * len(items))
+
+    assert drain_notification_outbox() == {'sent': 0, 'retry': 1, 'dead': 0}
+    row.refresh_from_db()
+    assert row.attempts == 1
+    assert row.next_attempt_at == fixed_now + timedelta(seconds=30)
+    assert row.last_error
+
+    # Not due yet: nothing to do
+    assert drain_notification_outbox() == {'sent': 0, 'retry': 0, 'dead': 0}
+
+    later = fixed_now + timedelta(seconds=30)
+    monkeypatch.setattr(timezone, 'now', lambda: later)
+    assert drain_notification_outbox() == {'sent': 0, 'retry': 0, 'dead': 1}
+    row.refresh_from_db()
+    assert row.status == NotificationOutbox.Status.DEAD
+
+
+@pytest.mark.django_db
+def test_drain_marks_sent(monkeypatch, user, fixed_now):
+    h = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Вода',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    row = NotificationOutbox.objects.create(habit=h, scheduled_for=fixed_now, text='hi', next_attempt_at=fixed_now)
+    monkeypatch.setattr('notifications.tasks.send_telegram_messages_batch', lambda items: [True] * len(items))
+
+    assert drain_notification_outbox()['sent'] == 1
+    row.refresh_from_db()
+    assert row.status == NotificationOutbox.Status.SENT
+    assert row.sent_at == fixed_now
+    assert row.claimed_by == ''
+
+
+@pytest.mark.django_db
+def test_drain_sends_a_claimed_batch_at_once(monkeypatch, user, fixed_now, django_assert_num_queries):
+    unlinked = get_user_model().objects.create_user(username='u2', password='pass12345')
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for owner, text in ((user, 'one'), (user, 'two'), (unlinked, 'three')):
+        h = Habit.objects.create(
+            user=owner, place='Дом', time=time(8, 0), action='Вода',
+            periodicity_days=1, reward='', duration_seconds=60,
+        )
+        NotificationOutbox.objects.create(habit=h, scheduled_for=fixed_now, text=text, next_attempt_at=fixed_now)
+    batches = []
+    monkeypatch.setattr(
+        'notifications.tasks.send_telegram_messages_batch', lambda items: batches.append(items) or [True] * len(items),
+    )
+
+    # claim (ids, UPDATE, rows with chat ids joined in) + write-back (SAVEPOINT, UPDATE, RELEASE) + empty claim
+    with django_assert_num_queries(3 + 3 + 1):
+        assert drain_notification_outbox() == {'sent': 2, 'retry': 1, 'dead': 0}
+
+    assert [sorted(batch) for batch in batches] == [[(1001, 'one'), (1001, 'two')]]
+    failed = NotificationOutbox.objects.get(text='three')
+    assert failed.last_error == 'No TelegramProfile'
@@ -1,10 +1,31 @@
+import json
 from datetime import time, datetime, timedelta
+from io import StringIO
+from types import SimpleNamespace
 
 import pytest
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.utils import timezone
 
-from habits.tasks import calc_next_run, check_and_notify_due_habits
-from habits.models import Habit
+from habits import locks
+from habits.locks import LocalLeases, lease_counters, single_flight
+from habits.tasks import (
+    IDEMPOTENCY_WINDOW_SECONDS,
+    SCHEDULER_LEASE,
+    calc_next_run,
+    check_and_notify_due_habits,
+    claim_due_habits,
+    dispatch_due_habits_shard,
+    dispatch_spread_slot,
+    init_next_run_at,
+    roll_habit_occurrences,
+    scheduled_habits,
+)
+from habits.models import Habit, HabitOccurrence, HabitQuerySet
+from habits.schedule import spread_offset
+from habits.simulation import simulate
+from notifications.models import TelegramProfile
 
 
 @pytest.mark.django_db
@@ -36,11 +57,12 @@ def test_check_and_notify_initializes_and_moves_schedule(monkeypatch, user):
     # Stub telegram sender to always succeed and record calls
     calls = {'count': 0}
 
-    def fake_send(user_arg, text):
-        calls['count'] += 1
-        return True
+    def fake_send(items):
+        calls['count'] += len(items)
+        return [True] * len(items)
 
-    monkeypatch.setattr('habits.tasks.send_telegram_message', fake_send)
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', fake_send)
+    TelegramProfile.objects.create(user=user, chat_id=1001)
 
     # Create a non-public habit without next_run_at (should be initialized)
     h = Habit.objects.create(
@@ -67,3 +89,697 @@ def test_check_and_notify_initializes_and_moves_schedule(monkeypatch, user):
     check_and_notify_due_habits()
     h.refresh_from_db()
     assert calls['count'] == 1
+
+
+@pytest.mark.django_db
+def test_init_next_run_at_bulk_matches_calc_next_run(user, django_assert_num_queries):
+    fixed_now = timezone.make_aware(datetime(2025, 1, 1, 10, 0, 0), timezone.get_current_timezone())
+    specs = [(time(9, 0), 2), (time(9, 0), 2), (time(11, 30), 1), (time(11, 30), 3)]
+    habits = [
+        Habit.objects.create(
+            user=user, place='Дом', time=t, action=f'Привычка {i}',
+            periodicity_days=p, reward='', duration_seconds=60,
+        )
+        for i, (t, p) in enumerate(specs)
+    ]
+    # Saving a habit schedules it: simulate rows left unscheduled (e.g. written by raw SQL)
+    Habit.objects.filter(id__in=[h.id for h in habits]).update(next_run_at=None)
+    already = Habit.objects.create(
+        user=user, place='Дом', time=time(12, 0), action='Уже запланирована',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+
+    # One query for the distinct groups plus one UPDATE per (time, periodicity_days)
+    with django_assert_num_queries(4):
+        updated = init_next_run_at(Habit.objects.all(), now=fixed_now)
+    assert updated == len(specs)
+
+    for h in habits:
+        h.refresh_from_db()
+        assert h.next_run_at == calc_next_run(h.time, h.periodicity_days, now=fixed_now)
+    already.refresh_from_db()
+    assert already.next_run_at == fixed_now
+
+
+@pytest.mark.django_db
+def test_dispatch_results_written_back_in_batches(monkeypatch, settings, user, django_assert_num_queries, fixed_now):
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', lambda items: [True] * len(items))
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    settings.HABITS_WRITEBACK_BATCH_SIZE = 2
+
+    for i in range(5):
+        Habit.objects.create(
+            user=user, place='Дом', time=time(7, 0), action=f'Привычка {i}',
+            periodicity_days=1, reward='', duration_seconds=60,
+            next_run_at=fixed_now - timedelta(minutes=1),
+        )
+
+    # 3 batches x (keyset page, claim: SAVEPOINT, SELECT, UPDATE, RELEASE, claimed rows
+    # with chat ids joined in, write-back: SAVEPOINT, UPDATE, RELEASE)
+    with django_assert_num_queries(3 * 9):
+        check_and_notify_due_habits()
+
+    for h in Habit.objects.all():
+        assert h.last_notified_at == fixed_now
+        assert h.next_run_at == fixed_now + timedelta(days=1) - timedelta(hours=1)
+
+
+@pytest.mark.django_db
+def test_batch_stays_due_and_unclaimed_when_the_send_raises(monkeypatch, settings, user, fixed_now):
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for i in range(3):
+        Habit.objects.create(
+            user=user, place='Дом', time=time(7, 0), action=f'Привычка {i}',
+            periodicity_days=1, reward='', duration_seconds=60,
+            next_run_at=fixed_now - timedelta(minutes=1),
+        )
+
+    def broken_send(items):
+        raise RuntimeError('event loop died')
+
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', broken_send)
+
+    with pytest.raises(RuntimeError):
+        check_and_notify_due_habits()
+
+    # Nothing was sent: the next tick picks the habits up again
+    assert Habit.objects.filter(next_run_at__lte=fixed_now, last_notified_at__isnull=True, claimed_by='').count() == 3
+
+
+@pytest.mark.django_db
+def test_beat_scan_claims_habits_before_sending(monkeypatch, user, fixed_now):
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Вода',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+    stolen = []
+
+    def send(items):
+        # run_scheduler ticking while the beat scan is sending
+        stolen.extend(claim_due_habits('daemon', fixed_now, limit=10))
+        return [True] * len(items)
+
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', send)
+    check_and_notify_due_habits()
+
+    assert stolen == []
+    assert Habit.objects.get().last_notified_at == fixed_now
+
+
+@pytest.mark.django_db
+def test_claim_skips_habits_unlinked_after_the_candidate_select(monkeypatch, user, fixed_now):
+    profile = TelegramProfile.objects.create(user=user, chat_id=1001)
+    habit = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Вода',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+    update = HabitQuerySet.update
+
+    def unlink_then_update(self, **kwargs):
+        # The chat is unlinked between the candidate select and the claiming UPDATE
+        if kwargs.get('claimed_by') == 'w0':
+            TelegramProfile.objects.filter(id=profile.id).delete()
+        return update(self, **kwargs)
+
+    monkeypatch.setattr(HabitQuerySet, 'update', unlink_then_update)
+
+    assert claim_due_habits('w0', fixed_now, limit=10) == []
+    habit.refresh_from_db()
+    assert habit.claimed_by == ''
+
+
+@pytest.mark.django_db
+def test_claim_mode_workers_get_disjoint_shards(user, fixed_now, sent):
+    other = get_user_model().objects.create_user(username='u2', password='pass12345')
+    for owner in (user, other):
+        TelegramProfile.objects.create(user=owner, chat_id=owner.id)
+        for i in range(3):
+            Habit.objects.create(
+                user=owner, place='Дом', time=time(8, 0), action=f'Привычка {i}',
+                periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+            )
+
+    shard0 = claim_due_habits('w0', fixed_now, limit=10, shard=0, shards=2)
+    shard1 = claim_due_habits('w1', fixed_now, limit=10, shard=1, shards=2)
+    assert {h.user_id % 2 for h in shard0} == {0}
+    assert {h.user_id % 2 for h in shard1} == {1}
+    assert len(shard0) + len(shard1) == 6
+
+    # Leased rows are neither re-claimed nor picked up by the plain scan
+    assert claim_due_habits('w2', fixed_now, limit=10) == []
+    check_and_notify_due_habits()
+    assert sent == []
+
+    # A shard worker sends its own chunk and releases the lease
+    Habit.objects.update(claimed_by='', claimed_until=None)
+    assert dispatch_due_habits_shard(0, 2) == 3
+    assert {chat_id % 2 for chat_id, text in sent} == {0}
+    assert not Habit.objects.exclude(claimed_by='').exists()
+
+
+@pytest.mark.django_db
+def test_claim_worker_leaves_recently_notified_habits_alone(monkeypatch, user, fixed_now, sent):
+    # E.g. the time was edited right after a reminder: still due, but inside the idempotency window
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    h = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Зарядка',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )
+    Habit.objects.filter(id=h.id).update(
+        next_run_at=fixed_now - timedelta(seconds=1), last_notified_at=fixed_now - timedelta(seconds=10),
+    )
+    calls = []
+    original = claim_due_habits
+
+    def counting_claim(*args, **kwargs):
+        calls.append(args)
+        assert len(calls) < 5, 'claim loop does not terminate'
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr('habits.tasks.claim_due_habits', counting_claim)
+
+    assert dispatch_due_habits_shard() == 0
+    assert len(calls) == 1
+    assert sent == []
+    h.refresh_from_db()
+    assert not h.claimed_by
+
+    # Once the window has passed it is claimed and sent as usual
+    later = fixed_now + timedelta(seconds=IDEMPOTENCY_WINDOW_SECONDS)
+    monkeypatch.setattr(timezone, 'now', lambda: later)
+    assert dispatch_due_habits_shard() == 1
+    assert len(sent) == 1
+
+
+@pytest.mark.django_db
+def test_run_scheduler_once_dispatches_due_habits(user, fixed_now, sent):
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+
+    due = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Пора',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+    Habit.objects.create(
+        user=user, place='Дом', time=time(9, 0), action='Позже',
+        periodicity_days=1, reward='', duration_seconds=60,
+        next_run_at=fixed_now + timedelta(hours=1),
+    )
+
+    call_command('run_scheduler', '--once', stdout=StringIO())
+
+    assert len(sent) == 1 and 'Пора' in sent[0][1]
+    due.refresh_from_db()
+    assert due.next_run_at == fixed_now + timedelta(days=1)
+    assert due.claimed_by == ''
+
+
+@pytest.mark.django_db
+def test_habits_of_unlinked_users_are_skipped_and_chat_ids_resolved_in_bulk(
+    monkeypatch, user, django_assert_num_queries,
+):
+    fixed_now = timezone.make_aware(datetime(2025, 1, 1, 8, 0, 0), timezone.get_current_timezone())
+    monkeypatch.setattr(timezone, 'now', lambda: fixed_now)
+    sent = []
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', lambda items: sent.extend(items) or [True] * len(items))
+
+    unlinked = get_user_model().objects.create_user(username='u2', password='pass12345')
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for owner in (user, user, unlinked):
+        Habit.objects.create(
+            user=owner, place='Дом', time=time(8, 0), action='Вода',
+            periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+        )
+
+    # due select (public owner in a subquery) + claim (SAVEPOINT, SELECT, UPDATE, RELEASE,
+    # claimed rows with joined chat ids) + one write-back batch
+    with django_assert_num_queries(1 + 5 + 3):
+        check_and_notify_due_habits()
+
+    assert [chat_id for chat_id, text in sent] == [1001, 1001]
+    skipped = Habit.objects.get(user=unlinked)
+    assert skipped.next_run_at == fixed_now
+    assert skipped.last_notified_at is None
+
+
+@pytest.mark.django_db
+def test_coalesce_sends_one_digest_per_user(settings, user, fixed_now, sent):
+    settings.HABITS_COALESCE_DIGEST = True
+    settings.HABITS_WRITEBACK_BATCH_SIZE = 2
+
+    other = get_user_model().objects.create_user(username='u2', password='pass12345')
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    TelegramProfile.objects.create(user=other, chat_id=1002)
+    for owner, action in ((user, 'Вода'), (user, 'Планка'), (user, 'Книга'), (other, 'Зарядка')):
+        Habit.objects.create(
+            user=owner, place='Дом', time=time(8, 0), action=action,
+            periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+        )
+
+    check_and_notify_due_habits()
+
+    assert sorted(chat_id for chat_id, text in sent) == [1001, 1002]
+    digest = dict(sent)[1001]
+    assert all(action in digest for action in ('Вода', 'Планка', 'Книга'))
+    assert not Habit.objects.filter(next_run_at__lte=fixed_now).exists()
+    assert Habit.objects.filter(last_notified_at=fixed_now).count() == 4
+
+
+@pytest.mark.django_db
+def test_catch_up_is_bounded_per_run_and_continues_from_cursor(monkeypatch, settings, user, fixed_now, sent):
+    settings.HABITS_MAX_PER_RUN = 3
+    settings.HABITS_WRITEBACK_BATCH_SIZE = 2
+    continuations = []
+    monkeypatch.setattr(check_and_notify_due_habits, 'delay', lambda **kw: continuations.append(kw['cursor']))
+
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for minutes in range(5):
+        Habit.objects.create(
+            user=user, place='Дом', time=time(8, 0), action=f'Привычка {minutes}',
+            periodicity_days=1, reward='', duration_seconds=60,
+            next_run_at=fixed_now - timedelta(minutes=50 - minutes),
+        )
+
+    check_and_notify_due_habits()
+    assert len(sent) == 3
+    assert len(continuations) == 1
+
+    check_and_notify_due_habits(cursor=continuations[0])
+    assert len(sent) == 5
+    assert len(continuations) == 1
+    assert not Habit.objects.filter(next_run_at__lte=fixed_now).exists()
+
+
+@pytest.mark.django_db
+def test_catch_up_limit_does_not_split_a_users_digest(monkeypatch, settings, fixed_now, sent):
+    settings.HABITS_COALESCE_DIGEST = True
+    settings.HABITS_MAX_PER_RUN = 3
+    settings.HABITS_WRITEBACK_BATCH_SIZE = 2
+    continuations = []
+    monkeypatch.setattr(check_and_notify_due_habits, 'delay', lambda **kw: continuations.append(kw['cursor']))
+
+    users = [get_user_model().objects.create_user(username=f'digest{n}', password='pass12345') for n in range(2)]
+    for n, (owner, count) in enumerate(zip(users, (2, 3))):
+        TelegramProfile.objects.create(user=owner, chat_id=2000 + n)
+        for i in range(count):
+            Habit.objects.create(
+                user=owner, place='Дом', time=time(8, 0), action=f'Привычка {i}',
+                periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+            )
+
+    check_and_notify_due_habits()
+    while continuations:
+        check_and_notify_due_habits(cursor=continuations.pop())
+
+    # The limit falls inside the second user's habits: they still get one digest
+    assert sorted(chat_id for chat_id, _ in sent) == [2000, 2001]
+    assert not Habit.objects.filter(next_run_at__lte=fixed_now).exists()
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('policy, expected_texts', [
+    ('skip', ['Свежая']),
+    ('collapse', ['Свежая', 'Пропущенные напоминания']),
+])
+def test_stale_policy(settings, user, policy, expected_texts, fixed_now, sent):
+    settings.HABITS_STALE_POLICY = policy
+    settings.HABITS_STALE_AFTER_SECONDS = 600
+
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for action, overdue in (('Свежая', 1), ('Старая 1', 120), ('Старая 2', 180)):
+        Habit.objects.create(
+            user=user, place='Дом', time=time(8, 0), action=action,
+            periodicity_days=1, reward='', duration_seconds=60,
+            next_run_at=fixed_now - timedelta(minutes=overdue),
+        )
+
+    check_and_notify_due_habits()
+
+    assert len(sent) == len(expected_texts)
+    for (chat_id, text), expected in zip(sent, expected_texts):
+        assert expected in text
+    assert not Habit.objects.filter(next_run_at__lte=fixed_now).exists()
+    stale_notified = Habit.objects.filter(action__startswith='Старая', last_notified_at=fixed_now).count()
+    assert stale_notified == (2 if policy == 'collapse' else 0)
+
+
+@pytest.mark.django_db
+def test_unknown_stale_policy_sends_instead_of_dropping(settings, user, caplog, fixed_now, sent):
+    settings.HABITS_STALE_POLICY = 'skipp'
+    settings.HABITS_STALE_AFTER_SECONDS = 600
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Старая',
+        periodicity_days=1, reward='', duration_seconds=60,
+        next_run_at=fixed_now - timedelta(hours=2),
+    )
+
+    check_and_notify_due_habits()
+
+    assert len(sent) == 1
+    assert 'HABITS_STALE_POLICY' in caplog.text
+
+
+@pytest.mark.django_db
+def test_scheduler_skips_public_owner_without_join(user, django_assert_num_queries):
+    call_command('seed_public_habits', stdout=StringIO())
+    public_id = get_user_model().objects.get(username='public').id
+    # A non-public habit of the public user must still be ignored
+    Habit.objects.create(
+        user_id=public_id, place='Дом', time=time(8, 0), action='Служебная',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )
+    own = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Своя',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )
+
+    with django_assert_num_queries(0):
+        qs = scheduled_habits()
+    assert list(qs.values_list('id', flat=True)) == [own.id]
+    sql = str(qs.query)
+    assert 'JOIN' not in sql
+    # The public owner is looked up in a subquery, not a join
+    assert sql.count('SELECT') == 2
+
+
+@pytest.mark.django_db
+def test_next_run_at_follows_every_write_path(monkeypatch, auth_client, user):
+    fixed_now = timezone.make_aware(datetime(2025, 1, 1, 10, 0, 0), timezone.get_current_timezone())
+    monkeypatch.setattr(timezone, 'now', lambda: fixed_now)
+
+    # Create via API: scheduled right away
+    resp = auth_client.post('/api/habits/', {
+        'place': 'Дом', 'time': '09:00:00', 'action': 'Зарядка',
+        'is_pleasant': False, 'periodicity_days': 2, 'reward': '', 'duration_seconds': 60,
+    }, format='json')
+    assert resp.status_code == 201, resp.content
+    h = Habit.objects.get(id=resp.data['id'])
+    assert h.next_run_at == fixed_now.replace(hour=9) + timedelta(days=2)
+
+    # Moving the time later today fires today, without waiting for the stale run
+    resp = auth_client.patch(f'/api/habits/{h.id}/', {'time': '11:30:00'}, format='json')
+    assert resp.status_code == 200, resp.content
+    h.refresh_from_db()
+    assert h.next_run_at == fixed_now.replace(hour=11, minute=30)
+
+    # Unrelated edits keep the schedule
+    Habit.objects.filter(id=h.id).update(next_run_at=fixed_now + timedelta(hours=5))
+    auth_client.patch(f'/api/habits/{h.id}/', {'place': 'Парк'}, format='json')
+    h.refresh_from_db()
+    assert h.next_run_at == fixed_now + timedelta(hours=5)
+
+    # Bulk paths; run_scheduler finds the change by `updated_at`
+    Habit.objects.filter(id=h.id).update(updated_at=fixed_now - timedelta(days=1))
+    Habit.objects.filter(id=h.id).update(time=time(12, 0))
+    h.refresh_from_db()
+    assert h.next_run_at == fixed_now.replace(hour=12)
+    assert h.updated_at == fixed_now
+    [bulk] = Habit.objects.bulk_create([Habit(
+        user=user, place='Дом', time=time(8, 0), action='Пачкой',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )])
+    assert bulk.next_run_at == fixed_now.replace(hour=8) + timedelta(days=1)
+
+    # Adopting a public template
+    call_command('seed_public_habits', stdout=StringIO())
+    template = Habit.objects.filter(is_public=True, linked_habit__isnull=True, is_pleasant=False).first()
+    resp = auth_client.post(f'/api/habits/public/{template.id}/adopt/')
+    assert resp.status_code == 201, resp.content
+    adopted = Habit.objects.get(id=resp.data['id'])
+    assert adopted.next_run_at == calc_next_run(template.time, template.periodicity_days, now=fixed_now)
+
+
+@pytest.mark.django_db
+def test_occurrence_buckets_drive_the_scheduler(monkeypatch, settings, user, sent):
+    settings.HABITS_USE_OCCURRENCES = True
+    settings.HABITS_OCCURRENCE_HORIZON_DAYS = 3
+    fixed_now = timezone.make_aware(datetime(2025, 1, 1, 7, 0, 0), timezone.get_current_timezone())
+    monkeypatch.setattr(timezone, 'now', lambda: fixed_now)
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+
+    h = Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Зарядка',
+        periodicity_days=1, reward='', duration_seconds=60,
+    )
+    minutes = list(h.occurrences.order_by('minute').values_list('minute', flat=True))
+    assert minutes == [h.next_run_at + timedelta(days=d) for d in range(3)]
+
+    # Rescheduling replaces the buckets
+    h.time = time(8, 30)
+    h.save()
+    assert h.occurrences.filter(minute=h.next_run_at).exists()
+    assert h.occurrences.count() == 3
+    call_command('habit_load', '--at', h.next_run_at.isoformat(), stdout=(out := StringIO()))
+    assert out.getvalue().strip().endswith(': 1')
+
+    due_at = h.next_run_at
+    monkeypatch.setattr(timezone, 'now', lambda: due_at)
+    check_and_notify_due_habits()
+    assert [chat_id for chat_id, _ in sent] == [1001]
+    h.refresh_from_db()
+    assert h.next_run_at == due_at + timedelta(days=1)
+    assert not h.occurrences.filter(minute__lte=due_at).exists()
+    assert h.occurrences.filter(minute=h.next_run_at).exists()
+
+
+@pytest.mark.django_db
+def test_enabling_occurrences_with_an_empty_table_keeps_reminders_flowing(monkeypatch, settings, user, fixed_now, sent):
+    rolls = []
+    monkeypatch.setattr(roll_habit_occurrences, 'delay', lambda: rolls.append(1))
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    # Created while the flag was off: no buckets
+    Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Зарядка',
+        periodicity_days=1, reward='', duration_seconds=60, next_run_at=fixed_now,
+    )
+    assert not HabitOccurrence.objects.exists()
+
+    settings.HABITS_USE_OCCURRENCES = True
+    check_and_notify_due_habits()
+    assert len(sent) == 1
+    assert rolls == [1]
+
+    # Once materialized, the buckets drive the scheduler again
+    roll_habit_occurrences()
+    check_and_notify_due_habits()
+    assert rolls == [1]
+    assert HabitOccurrence.objects.filter(minute__gt=fixed_now).exists()
+
+
+@pytest.mark.django_db
+def test_spread_window_paces_sends_within_the_minute(monkeypatch, settings, user, fixed_now):
+    settings.HABITS_SPREAD_WINDOW_SECONDS = 30
+    counts = [0] * 60
+    for habit_id in range(1, 601):
+        counts[spread_offset(habit_id, 60)] += 1
+    assert min(counts) >= 5 and max(counts) <= 15
+
+    clock = {'now': fixed_now}
+    monkeypatch.setattr(timezone, 'now', lambda: clock['now'])
+    deferred = []
+    monkeypatch.setattr(dispatch_spread_slot, 'apply_async', lambda args, eta: deferred.append((eta, args)))
+    sent = []
+    monkeypatch.setattr(
+        'habits.tasks.send_telegram_messages_batch',
+        lambda items: sent.extend((clock['now'], text) for _, text in items) or [True] * len(items),
+    )
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    habits = [
+        Habit.objects.create(
+            user=user, place='Дом', time=time(8, 0), action=f'Привычка {n}',
+            periodicity_days=1, reward='', duration_seconds=60,
+        )
+        for n in range(6)
+    ]
+
+    # The tick itself doesn't wait: later slots are leased and handed over with an ETA
+    check_and_notify_due_habits()
+    assert all(at == fixed_now for at, _ in sent)
+    assert deferred
+    leased = Habit.objects.exclude(claimed_by='')
+    assert leased.count() == sum(len(ids) for _, (ids, _token) in deferred)
+    # A tick during the slot wait doesn't touch the leased habits
+    check_and_notify_due_habits()
+    assert len(sent) == 6 - leased.count()
+
+    for eta, args in sorted(deferred):
+        clock['now'] = eta
+        dispatch_spread_slot(*args)
+    assert len(sent) == 6
+    for at, text in sent:
+        habit = next(h for h in habits if h.action in text)
+        assert at == fixed_now + timedelta(seconds=spread_offset(habit.id, 30))
+    assert all(at < fixed_now + timedelta(seconds=30) for at, _ in sent)
+    assert not Habit.objects.exclude(claimed_by='').exists()
+    assert not Habit.objects.filter(next_run_at__lte=fixed_now).exists()
+
+
+@pytest.mark.django_db
+def test_late_tick_spreads_over_the_rest_of_the_minute(monkeypatch, settings, user, fixed_now, sent):
+    settings.HABITS_SPREAD_WINDOW_SECONDS = 60
+    clock = {'now': fixed_now}
+    monkeypatch.setattr(timezone, 'now', lambda: clock['now'])
+    deferred = []
+    monkeypatch.setattr(dispatch_spread_slot, 'apply_async', lambda args, eta: deferred.append((eta, args)))
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    habits = [
+        Habit.objects.create(
+            user=user, place='Дом', time=time(8, 0), action=f'Привычка {n}',
+            periodicity_days=1, reward='', duration_seconds=60,
+        )
+        for n in range(6)
+    ]
+
+    # Beat ticks 45 s into the minute: the slots passed so far are not sent in one burst
+    tick = fixed_now + timedelta(seconds=45)
+    clock['now'] = tick
+    check_and_notify_due_habits()
+
+    assert len(sent) == sum(1 for h in habits if spread_offset(h.id, 60) == 0)
+    assert deferred
+    for eta, (ids, _token) in deferred:
+        assert tick < eta < fixed_now + timedelta(seconds=60)
+        for h in Habit.objects.filter(id__in=ids):
+            assert eta == tick + timedelta(seconds=spread_offset(h.id, 60) * 15 / 60)
+
+
+@pytest.mark.django_db
+def test_spread_window_keeps_a_users_digest_together(monkeypatch, settings, fixed_now, sent):
+    settings.HABITS_SPREAD_WINDOW_SECONDS = 60
+    settings.HABITS_COALESCE_DIGEST = True
+    settings.HABITS_WRITEBACK_BATCH_SIZE = 2
+    clock = {'now': fixed_now}
+    monkeypatch.setattr(timezone, 'now', lambda: clock['now'])
+    deferred = []
+    monkeypatch.setattr(dispatch_spread_slot, 'apply_async', lambda args, eta: deferred.append((eta, args)))
+    users = [get_user_model().objects.create_user(username=f'spread{n}', password='pass12345') for n in range(3)]
+    for n, u in enumerate(users):
+        TelegramProfile.objects.create(user=u, chat_id=2000 + n)
+        for action in ('Вода', 'Планка'):
+            Habit.objects.create(
+                user=u, place='Дом', time=time(8, 0), action=action,
+                periodicity_days=1, reward='', duration_seconds=60,
+            )
+
+    check_and_notify_due_habits()
+    for eta, args in sorted(deferred):
+        clock['now'] = eta
+        dispatch_spread_slot(*args)
+
+    # One digest per user, each at the user's own second
+    assert sorted(chat_id for chat_id, _ in sent) == [2000, 2001, 2002]
+    assert all('Вода' in text and 'Планка' in text for _, text in sent)
+    for eta, (ids, _token) in deferred:
+        for h in Habit.objects.filter(id__in=ids):
+            assert eta == fixed_now + timedelta(seconds=spread_offset(h.user_id, 60))
+
+
+@pytest.mark.django_db
+def test_overlapping_tick_is_skipped_while_the_lease_is_held(user, sent):
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    Habit.objects.create(
+        user=user, place='Дом', time=time(8, 0), action='Зарядка',
+        periodicity_days=1, reward='', duration_seconds=60,
+        next_run_at=timezone.now() - timedelta(minutes=1),
+    )
+    before = lease_counters(SCHEDULER_LEASE)
+
+    with single_flight(SCHEDULER_LEASE) as acquired:
+        assert acquired
+        check_and_notify_due_habits()
+        assert sent == []
+
+    check_and_notify_due_habits()
+    assert len(sent) == 1
+
+    after = lease_counters(SCHEDULER_LEASE)
+    assert after['contended'] - before.get('contended', 0) == 1
+    assert after['acquired'] - before.get('acquired', 0) == 2
+    assert after.get('expired', 0) == before.get('expired', 0)
+
+
+def test_lease_is_only_extended_by_its_holder():
+    leases = LocalLeases()
+    assert leases.acquire('job', 'a', ttl=60)
+    assert not leases.extend('job', 'b', ttl=60)
+    assert leases.extend('job', 'a', ttl=60)
+    assert leases.release('job', 'a')
+    assert not leases.extend('job', 'a', ttl=60)
+
+
+@pytest.mark.django_db
+def test_long_run_renews_its_lease_between_batches(monkeypatch, settings, user):
+    settings.HABITS_WRITEBACK_BATCH_SIZE = 2
+    settings.HABITS_SCHEDULER_LOCK_TTL_SECONDS = 250
+    clock = {'now': 0.0}
+    monkeypatch.setattr(locks, 'time', SimpleNamespace(monotonic=lambda: clock['now']))
+
+    def slow_send(items):
+        # Each batch takes 100 s: the whole run outlives the TTL
+        clock['now'] += 100
+        return [True] * len(items)
+
+    monkeypatch.setattr('habits.tasks.send_telegram_messages_batch', slow_send)
+    TelegramProfile.objects.create(user=user, chat_id=1001)
+    for i in range(5):
+        Habit.objects.create(
+            user=user, place='Дом', time=time(8, 0), action=f'Привычка {i}',
+            periodicity_days=1, reward='', duration_seconds=60,
+            next_run_at=timezone.now() - timedelta(minutes=1),
+        )
+    before = locks.lease_counters(SCHEDULER_LEASE)
+
+    check_and_notify_due_habits()
+
+    assert clock['now'] == 300
+    assert locks.lease_counters(SCHEDULER_LEASE).get('expired', 0) == before.get('expired', 0)
+
+
+@pytest.mark.django_db
+def test_bench_scheduler_reports_json(tmp_path):
+    report_path = tmp_path / 'bench.json'
+    call_command(
+        'bench_scheduler', '--in-place', '--users', '5', '--habits', '40', '--ticks', '2',
+        '--latency-ms', '0', '--output', str(report_path),
+    )
+    report = json.loads(report_path.read_text(encoding='utf-8'))
+    assert report['population']['habits'] == 40
+    assert len(report['ticks']) == 2
+    for tick in report['ticks']:
+        assert tick['dispatched'] == tick['due'] > 0
+        assert tick['queries'] > 0
+    assert report['summary']['peak_rss_mb'] > 0
+
+
+@pytest.mark.django_db
+def test_simulate_schedule_replays_a_week(user):
+    start = timezone.make_aware(datetime(2025, 1, 6, 0, 0), timezone.get_current_timezone())
+    other = get_user_model().objects.create_user(username='u2', password='pass12345')
+
+    def make(owner, at, periodicity_days):
+        habit = Habit.objects.create(
+            user=owner, place='Дом', time=at, action='Зарядка',
+            periodicity_days=periodicity_days, reward='', duration_seconds=60,
+        )
+        Habit.objects.filter(pk=habit.pk).update(next_run_at=calc_next_run(at, periodicity_days, now=start))
+
+    make(user, time(8, 0), 1)
+    make(user, time(8, 0), 2)
+    make(other, time(8, 0), 1)
+    make(other, time(21, 30), 7)
+
+    result = simulate(scheduled_habits(), start, days=7)
+    assert result.habits == 4
+    assert result.schedules == 3
+    # 7 + 4 + 7 + 1
+    assert result.total_sends == 19
+    peak_minute, peak_sends = result.peak()
+    assert peak_minute == start.replace(hour=8) and peak_sends == 3
+    assert result.max_per_user_minute == 2
+    # One digest per user: the first user's two habits share a message on 4 days
+    assert sum(result.api_calls(coalesce=True).values()) == 15
+
+    out = StringIO()
+    call_command('simulate_schedule', '--start', '2025-01-06 00:00', '--json', stdout=out)
+    assert '"peak_sends": 3' in out.getvalue()